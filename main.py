@@ -1,218 +1,2719 @@
 from flask import Flask, request, jsonify
+from flask.json.provider import DefaultJSONProvider
 import pandas as pd
 import json
 from datetime import datetime
 from flask_cors import CORS
 import math
 import numpy as np
+import hashlib
+import os
 import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+import multiprocessing
+from multiprocessing import shared_memory
+
+try:
+    import ijson
+except ImportError:  # без ijson качените файлове се четат изцяло с json.load
+    ijson = None
+
+try:
+    import orjson
+except ImportError:  # без orjson JSON се обработва от стандартния json модул
+    orjson = None
+
+try:
+    import redis
+except ImportError:  # без redis кешът на резултатите е само в паметта на процеса
+    redis = None
+
+try:
+    import polars as pl
+except ImportError:  # без polars няма polars изпълнител
+    pl = None
+
+try:
+    import duckdb
+except ImportError:  # без duckdb няма SQL изпълнител
+    duckdb = None
+
+try:
+    import numba
+except ImportError:  # без numba статистиките по контрагент се смятат с pandas groupby
+    numba = None
 
 app = Flask(__name__)
-CORS(app)
+CORS(app, expose_headers=["ETag", "X-Cache"])
 
 
-def fix_nan(obj):
+def _finite(obj):
+    """Copy of `obj` with NaN/Infinity floats inside dicts and lists replaced by None."""
+    if isinstance(obj, (float, np.floating)):
+        return obj if math.isfinite(obj) else None
     if isinstance(obj, dict):
-        return {k: fix_nan(v) for k, v in obj.items()}
-    elif isinstance(obj, list):
-        return [fix_nan(x) for x in obj]
-    elif isinstance(obj, float) and math.isnan(obj):
-        return None
+        return {key: _finite(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_finite(value) for value in obj]
+    return obj
+
+
+class SafeJSONEncoder(json.JSONEncoder):
+    """JSON encoder that writes NaN/Infinity as null and unwraps NumPy/pandas scalars.
+
+    Encoding runs on the C encoder with allow_nan off; only a result that
+    does contain a non-finite float is cleaned with _finite() and encoded
+    again.
+    """
+
+    def __init__(self, **kwargs):
+        kwargs["allow_nan"] = False
+        super().__init__(**kwargs)
+
+    def default(self, o):
+        if o is pd.NaT:
+            return None
+        if isinstance(o, np.integer):
+            return int(o)
+        if isinstance(o, np.floating):
+            return float(o)
+        if isinstance(o, np.bool_):
+            return bool(o)
+        if isinstance(o, np.ndarray):
+            return o.tolist()
+        if isinstance(o, pd.Timestamp):
+            return o.isoformat()
+        return DefaultJSONProvider.default(o)
+
+    def encode(self, o):
+        try:
+            return super().encode(o)
+        except ValueError:  # NaN/Infinity в резултата
+            return super().encode(_finite(o))
+
+
+class SafeJSONProvider(DefaultJSONProvider):
+    """Flask JSON provider for request and response bodies.
+
+    Uses orjson when it is installed and `use_orjson` is left on: it
+    serializes NumPy scalars natively and writes NaN as null, with
+    SafeJSONEncoder.default covering the remaining types. Otherwise falls
+    back to the stdlib json module with SafeJSONEncoder.
+    """
+
+    use_orjson = orjson is not None
+
+    def dumps(self, obj, **kwargs):
+        if self.use_orjson:
+            option = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+            if kwargs.get("sort_keys", self.sort_keys):
+                option |= orjson.OPT_SORT_KEYS
+            if kwargs.get("indent"):
+                option |= orjson.OPT_INDENT_2
+            return orjson.dumps(obj, default=SafeJSONEncoder().default, option=option).decode()
+
+        kwargs.setdefault("cls", SafeJSONEncoder)
+        kwargs.setdefault("ensure_ascii", self.ensure_ascii)
+        kwargs.setdefault("sort_keys", self.sort_keys)
+        return json.dumps(obj, **kwargs)
+
+    def loads(self, s, **kwargs):
+        if self.use_orjson and not kwargs:
+            try:
+                return orjson.loads(s)
+            except orjson.JSONDecodeError:
+                pass  # напр. NaN литерали, които само json модулът приема
+        return super().loads(s, **kwargs)
+
+
+app.json = SafeJSONProvider(app)
+
+
+# Префикси в описанието, след които стои името на контрагента, напр. "AZV-,POS ,ATM "
+REMITTANCE_PREFIXES = tuple(p for p in os.environ.get("REMITTANCE_PREFIXES", "AZV-").split(",") if p)
+
+
+def _trie_pattern(words):
+    """Regex source matching any of `words`, nested as a character trie.
+
+    Words sharing a start share one branch, so at every position the regex
+    follows at most one path per character instead of trying each word in
+    turn; where one word extends another the longer one is tried first.
+    """
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[None] = {}
+
+    def build(node):
+        branches = [re.escape(char) + build(child) for char, child in sorted(node.items(), key=str) if char is not None]
+        if not branches:
+            return ""
+        if len(branches) == 1 and None not in node:
+            return branches[0]
+        return "(?:" + "|".join(branches) + (")?" if None in node else ")")
+
+    return build(trie)
+
+
+@lru_cache(maxsize=32)
+def remittance_pattern(prefixes):
+    """One compiled pattern matching the first non-empty entity after any of `prefixes`.
+
+    The prefixes are folded into a trie (see _trie_pattern), so adding
+    prefixes barely changes the cost of a scan, where a flat alternation
+    tries every prefix at every position. A single prefix is a plain
+    literal, which re finds with a faster substring search; any second
+    prefix gives that up once.
+    """
+    return re.compile(rf"{_trie_pattern(set(prefixes))}\s*([^,\s][^,]*)")
+
+
+def extract_remittance_counterparties(remittance, prefixes=REMITTANCE_PREFIXES):
+    """First entity after one of `prefixes` in every description of a Series, NaN where there is none.
+
+    Runs the compiled pattern over the whole column at once; values that are
+    not strings never match.
+    """
+    if not prefixes:
+        return pd.Series(None, index=remittance.index, dtype=object)
+    try:
+        entities = remittance.str.extract(remittance_pattern(tuple(prefixes)), expand=False)
+    except AttributeError:  # в колоната няма нито един текст
+        return pd.Series(None, index=remittance.index, dtype=object)
+    return entities.str.strip()
+
+
+def _text_column(df, name):
+    """Return column `name` as an object Series, or an all-missing one if absent."""
+    if name in df.columns:
+        return df[name].astype(object)
+    return pd.Series(None, index=df.index, dtype=object)
+
+
+def _has_text(series):
+    """Mask of values that are present and not just whitespace."""
+    return series.notna() & series.astype(str).str.strip().ne("")
+
+
+def _format_dates(series):
+    """Format datetimes as 'YYYY-MM-DD' strings, with None for missing dates."""
+    formatted = series.dt.strftime("%Y-%m-%d").astype(object)
+    return formatted.where(series.notna(), None)
+
+
+def resolve_counterparties(df, remittance_prefixes=REMITTANCE_PREFIXES):
+    """Resolve the counterparty of every transaction in one columnar pass.
+
+    Incoming payments prefer the debtor, outgoing ones the creditor, each
+    falling back to the other name; rows left without a name fall back to
+    the first entity after one of `remittance_prefixes` in the remittance
+    information.
+    """
+    creditor = _text_column(df, "creditorName")
+    debtor = _text_column(df, "debtorName")
+    has_creditor = _has_text(creditor)
+    has_debtor = _has_text(debtor)
+    incoming = df["amount"] > 0
+    outgoing = df["amount"] < 0
+
+    counterparty = pd.Series(
+        np.select(
+            [incoming & has_debtor, incoming & has_creditor, outgoing & has_creditor, outgoing & has_debtor],
+            [debtor, creditor, creditor, debtor],
+            default=None,
+        ),
+        index=df.index,
+        dtype=object,
+    )
+
+    # ако няма контрагент, търсим в описанието
+    missing = counterparty.isna()
+    if missing.any():
+        remittance = _text_column(df, "remittanceInformationUnstructured")[missing]
+        counterparty[missing] = extract_remittance_counterparties(remittance, remittance_prefixes)
+
+    return counterparty
+
+
+def _grouped_mode(frame, key, column):
+    """Most frequent `column` value per `key`, ties resolved like Series.mode()[0]."""
+    counts = frame.groupby([key, column]).size().rename("n").reset_index()
+    counts = counts.sort_values([key, "n", column], ascending=[True, False, True], kind="stable")
+    return counts.drop_duplicates(key).set_index(key)[column]
+
+
+def _trend_slope(n, sum_y, sum_xy):
+    """Least-squares slope of y over x = 0..n-1 from grouped sums.
+
+    With x fixed to the positions, sum(x) and sum(x^2) are known in closed
+    form, so the slope reduces to (sum(xy) - mean(x) * sum(y)) / Sxx with
+    Sxx = n(n^2 - 1) / 12. Groups with fewer than two points get NaN.
+    """
+    n = n.astype(float)
+    sxx = n * (n * n - 1) / 12
+    slope = (sum_xy - (n - 1) / 2 * sum_y) / sxx
+    return slope.where(n >= 2)
+
+
+# Колоните, които _group_moments връща, в този ред
+MOMENT_COLUMNS = (
+    "count", "mean", "std", "std_pop", "date_count", "interval_mean", "interval_std", "amount_sum", "weighted_sum",
+)
+_NAT = np.iinfo(np.int64).min
+_DAY_NS = 86_400_000_000_000
+
+
+def _group_moments(starts, amounts, dates):
+    """Per-group moments over rows sorted by (group, date), in one loop.
+
+    `starts` holds the offset of every group plus the total row count;
+    `dates` are nanosecond timestamps with NaT last in each group. Sums use
+    Kahan compensation and variances Welford's update, the same algorithms
+    pandas' groupby kernels use, so results match them exactly.
+    """
+    groups = len(starts) - 1
+    out = np.full((groups, 9), np.nan)
+    for g in range(groups):
+        count = 0
+        amount_sum = amount_comp = weighted_sum = weighted_comp = 0.0
+        mean = m2 = 0.0
+        dated = intervals = 0
+        interval_sum = interval_comp = interval_mean = interval_m2 = 0.0
+        previous = _NAT
+        for i in range(starts[g], starts[g + 1]):
+            value = amounts[i]
+
+            y = value - amount_comp
+            t = amount_sum + y
+            amount_comp = t - amount_sum - y
+            amount_sum = t
+
+            y = count * value - weighted_comp
+            t = weighted_sum + y
+            weighted_comp = t - weighted_sum - y
+            weighted_sum = t
+
+            count += 1
+            delta = value - mean
+            mean += delta / count
+            m2 += (value - mean) * delta
+
+            if dates[i] != _NAT:
+                dated += 1
+                if previous != _NAT:
+                    interval = float((dates[i] - previous) // _DAY_NS)
+                    y = interval - interval_comp
+                    t = interval_sum + y
+                    interval_comp = t - interval_sum - y
+                    interval_sum = t
+
+                    intervals += 1
+                    delta = interval - interval_mean
+                    interval_mean += delta / intervals
+                    interval_m2 += (interval - interval_mean) * delta
+                previous = dates[i]
+
+        out[g, 0] = count
+        out[g, 1] = amount_sum / count
+        if count > 1:
+            out[g, 2] = np.sqrt(m2 / (count - 1))
+        out[g, 3] = np.sqrt(m2 / count)
+        out[g, 4] = dated
+        if intervals > 0:
+            out[g, 5] = interval_sum / intervals
+        if intervals > 1:
+            out[g, 6] = np.sqrt(interval_m2 / (intervals - 1))
+        out[g, 7] = amount_sum
+        out[g, 8] = weighted_sum
+    return out
+
+
+if numba is not None:
+    _group_moments = numba.njit(cache=True)(_group_moments)
+
+
+def counterparty_statistics(df):
+    """Per-counterparty statistics shared by the frequency, outlier and profile sections.
+
+    The frame is sorted once by (counterparty, bookingDate) and every
+    aggregate - amount moments, booking intervals, weekday mode and trend -
+    is derived from that single ordering.
+    """
+    ordered = df[df["counterparty"].notna()].sort_values(["counterparty", "bookingDate"], kind="stable")
+    ordered = ordered.assign(weekday=ordered["bookingDate"].dt.day_name())
+
+    if numba is not None:
+        # с numba всички моменти се смятат в един цикъл по подредените масиви
+        names = ordered["counterparty"].to_numpy()
+        starts = np.r_[0, np.flatnonzero(names[1:] != names[:-1]) + 1, len(names)] if len(names) else np.r_[0]
+        starts = starts.astype(np.int64)
+        stats = pd.DataFrame(
+            _group_moments(
+                starts,
+                ordered["amount"].to_numpy(dtype=np.float64),
+                ordered["bookingDate"].to_numpy(dtype="datetime64[ns]").view(np.int64),
+            ),
+            index=pd.Index(names[starts[:-1]], name="counterparty"),
+            columns=MOMENT_COLUMNS,
+        )
     else:
-        return obj
+        position = ordered.groupby("counterparty").cumcount()
+        ordered = ordered.assign(
+            interval=ordered.groupby("counterparty")["bookingDate"].diff().dt.days,
+            weighted=position * ordered["amount"],
+        )
+        grouped = ordered.groupby("counterparty")
+        stats = grouped.agg(
+            count=("amount", "size"),
+            mean=("amount", "mean"),
+            std=("amount", "std"),
+            date_count=("bookingDate", "count"),
+            interval_mean=("interval", "mean"),
+            interval_std=("interval", "std"),
+            amount_sum=("amount", "sum"),
+            weighted_sum=("weighted", "sum"),
+        )
+        stats["std_pop"] = grouped["amount"].std(ddof=0)
+
+    stats["slope"] = _trend_slope(stats["count"], stats["amount_sum"], stats["weighted_sum"])
+    stats["most_active_day"] = _grouped_mode(ordered, "counterparty", "weekday").reindex(stats.index)
+    return stats
+
+
+def find_duplicates(df):
+    """Transactions sharing counterparty, amount and currency with at least one other."""
+    return _duplicate_records(df, duplicate_mask(df))
+
+
+def duplicate_mask(df):
+    """Mask of the rows find_duplicates() reports.
+
+    Rows are keyed on the raw (counterparty, amount, currency) values and
+    matched with a single hash-based duplicated() mask; rows with a missing
+    key are never considered duplicates.
+    """
+    keys = pd.DataFrame({
+        "counterparty": df["counterparty"],
+        "amount": _text_column(df, "transactionAmount.amount"),
+        "currency": _text_column(df, "transactionAmount.currency"),
+    })
+    return keys.notna().all(axis=1) & keys.duplicated(keep=False)
+
+
+def find_near_duplicates(df, window_days, amount_tolerance=0.0):
+    """Transactions with a similar payment to the same counterparty within `window_days`."""
+    return _duplicate_records(df, near_duplicate_mask(df, window_days, amount_tolerance))
+
+
+def near_duplicate_mask(df, window_days, amount_tolerance=0.0):
+    """Mask of the rows find_near_duplicates() reports.
+
+    Two transactions match when they share counterparty and currency, were
+    booked at most `window_days` apart and their amounts differ by at most
+    `amount_tolerance`. Rows are sorted by (key, bookingDate); for an exact
+    amount match the amount joins the key and each row is compared with the
+    one before it, otherwise rows are matched on a (day, amount) grid (see
+    _tolerance_matches). Rows without a booking date are skipped.
+    """
+    exact = amount_tolerance <= 0
+    candidates = pd.DataFrame({
+        "counterparty": df["counterparty"],
+        "currency": _text_column(df, "transactionAmount.currency"),
+        "amount": df["amount"],
+        "bookingDate": df["bookingDate"],
+    }).dropna()
+    if candidates.empty:
+        return pd.Series(False, index=df.index)
+
+    key = ["counterparty", "currency", "amount"] if exact else ["counterparty", "currency"]
+    ordered = candidates.sort_values(key + ["bookingDate"], kind="stable")
+    flagged = _window_matches(
+        ordered.groupby(key, sort=False).ngroup().to_numpy(),
+        ordered["bookingDate"].to_numpy().astype("datetime64[D]").astype(np.int64),
+        ordered["amount"].to_numpy(),
+        window_days,
+        amount_tolerance,
+    )
+
+    return pd.Series(flagged, index=ordered.index).reindex(df.index, fill_value=False)
+
+
+def _window_matches(group, days, amounts, window_days, amount_tolerance):
+    """Mark rows sorted by (group, day) that have a match inside the window.
+
+    `group` holds consecutive integer ids. With a zero tolerance the amount
+    is expected to be part of the group, so comparing every row with the
+    one before it is enough; otherwise see _tolerance_matches().
+    """
+    if amount_tolerance > 0:
+        return _tolerance_matches(group, days, amounts, window_days, amount_tolerance)
+
+    # (група, ден) като едно монотонно число, за да намерим началото на прозореца с searchsorted
+    days = days - days.min()
+    position = group * (days.max() + window_days + 1) + days
+    reach = np.arange(len(position)) - np.searchsorted(position, position - window_days, side="left")
+
+    flagged = np.zeros(len(position), dtype=bool)
+    rows = np.flatnonzero(reach >= 1)
+    rows = rows[np.abs(amounts[rows] - amounts[rows - 1]) <= amount_tolerance]
+    flagged[rows] = True
+    flagged[rows - 1] = True
+    return flagged
+
+
+def _tolerance_matches(group, days, amounts, window_days, amount_tolerance):
+    """Mark rows with another row of their group within `window_days` and `amount_tolerance`.
+
+    Rows are bucketed into cells window_days + 1 days by amount_tolerance
+    wide, so any two rows sharing a cell match. Only rows alone in their
+    cell are compared exactly, against the rows of the eight neighbouring
+    cells; a cell neighbours at most eight single-row cells, so at most 8n
+    pairs are checked and the cost stays O(n log n) however dense the
+    window gets.
+    """
+    flagged = np.zeros(len(days), dtype=bool)
+    if window_days < 0 or len(days) == 0:
+        return flagged
 
+    cells = pd.DataFrame({
+        "group": group,
+        "day_cell": days // (window_days + 1),
+        "amount_cell": np.floor(amounts / amount_tolerance).astype(np.int64),
+    })
+    size = cells.groupby(list(cells.columns), sort=False)["group"].transform("size").to_numpy()
+    flagged[size > 1] = True
 
-def extract_azv_entities(transaction):
-    """Extract counterparty names from 'AZV-' patterns in transaction description."""
-    if not isinstance(transaction, str):
+    # самотните редове се сравняват с редовете в съседните клетки
+    alone = np.flatnonzero(size == 1)
+    day_step, amount_step = np.array([(d, a) for d in (-1, 0, 1) for a in (-1, 0, 1) if (d, a) != (0, 0)]).T
+    probes = pd.DataFrame({
+        "row": np.repeat(alone, 8),
+        "group": np.repeat(cells["group"].to_numpy()[alone], 8),
+        "day_cell": np.repeat(cells["day_cell"].to_numpy()[alone], 8) + np.tile(day_step, alone.size),
+        "amount_cell": np.repeat(cells["amount_cell"].to_numpy()[alone], 8) + np.tile(amount_step, alone.size),
+    })
+    pairs = probes.merge(cells.assign(other=np.arange(len(cells))), on=["group", "day_cell", "amount_cell"])
+    row = pairs["row"].to_numpy()
+    other = pairs["other"].to_numpy()
+    match = (np.abs(days[row] - days[other]) <= window_days) & (np.abs(amounts[row] - amounts[other]) <= amount_tolerance)
+    flagged[row[match]] = True
+    flagged[other[match]] = True
+    return flagged
+
+
+def _duplicate_records(df, mask):
+    """Build the potential_duplicates records for the rows selected by `mask`."""
+    if not mask.any():
         return []
-    matches = re.findall(r'AZV-([^,]+)', transaction)
-    return list({m.strip() for m in matches if m.strip()})
 
+    duplicates = pd.DataFrame({
+        "bookingDate": _format_dates(df.loc[mask, "bookingDate"]),
+        "counterparty": df.loc[mask, "counterparty"],
+        "amount": _text_column(df, "transactionAmount.amount")[mask],
+        "currency": _text_column(df, "transactionAmount.currency")[mask],
+        "iban": _text_column(df, "creditorAccount.iban")[mask],
+        "remittance": _text_column(df, "remittanceInformationUnstructured")[mask],
+    })
+    return duplicates.astype(object).where(duplicates.notna(), None).to_dict("records")
+
+
+def detect_outliers(df, stats, threshold=2.5):
+    """Flag transactions whose amount z-score within their counterparty exceeds `threshold`.
+
+    Per-counterparty mean and population std are broadcast back onto the
+    rows from `stats`, so the whole frame is tested with one boolean mask.
+    Only counterparties with more than two transactions and non-zero spread
+    are considered.
+    """
+    counterparty = df["counterparty"]
+    count = counterparty.map(stats["count"])
+    mean = counterparty.map(stats["mean"])
+    std = counterparty.map(stats["std_pop"])
+    z_score = (df["amount"] - mean) / std
+
+    mask = (count > 2) & (std > 0) & (z_score.abs() > threshold)
+    return _outlier_records(pd.DataFrame({
+        "counterparty": counterparty[mask],
+        "amount": df.loc[mask, "amount"],
+        "mean": mean[mask],
+        "std_dev": std[mask],
+        "z_score": z_score[mask],
+        "currency": df.loc[mask, "currency"],
+        "bookingDate": df.loc[mask, "bookingDate"],
+    }))
+
+
+def _outlier_records(flagged):
+    """Build the outlier records from flagged rows carrying their group mean, std_dev and z_score."""
+    if flagged.empty:
+        return []
+
+    flagged = flagged.assign(
+        mean=flagged["mean"].round(2),
+        std_dev=flagged["std_dev"].round(2),
+        z_score=flagged["z_score"].round(2),
+        bookingDate=_format_dates(flagged["bookingDate"]),
+        reason=np.where(
+            flagged["z_score"] > 0, "Unusually high transaction amount", "Unusually low transaction amount"
+        ),
+    )
+    return flagged.sort_values("counterparty", kind="stable").to_dict("records")
+
+
+# Колоните, които анализът чете, и пътят до тях в транзакцията (Berlin Group)
+TRANSACTION_FIELDS = {
+    "transactionAmount.amount": ("transactionAmount", "amount"),
+    "transactionAmount.currency": ("transactionAmount", "currency"),
+    "bookingDate": ("bookingDate",),
+    "creditorName": ("creditorName",),
+    "debtorName": ("debtorName",),
+    "creditorAccount.iban": ("creditorAccount", "iban"),
+    "remittanceInformationUnstructured": ("remittanceInformationUnstructured",),
+}
+
+
+def _field_values(transactions, path):
+    """Values at `path` for every transaction, None where the path is missing."""
+    values = transactions
+    for key in path:
+        values = [value.get(key) if isinstance(value, dict) else None for value in values]
+    return values
+
+
+def _columns_frame(columns):
+    """Frame from column lists, leaving out fields no transaction carries, like pd.json_normalize."""
+    return pd.DataFrame({
+        name: values for name, values in columns.items() if any(value is not None for value in values)
+    })
+
+
+def transaction_columns(transactions):
+    """TRANSACTION_FIELDS column lists of a list of transactions."""
+    return {name: _field_values(transactions, path) for name, path in TRANSACTION_FIELDS.items()}
+
+
+def build_transactions_frame(transactions):
+    """Extract only the TRANSACTION_FIELDS columns from a list of transactions."""
+    return _columns_frame(transaction_columns(transactions))
+
+
+class _ColumnBuffer:
+    """Append-only TRANSACTION_FIELDS column store for streamed transactions."""
+
+    def __init__(self):
+        self.columns = {name: [] for name in TRANSACTION_FIELDS}
+        self._paths = [(self.columns[name], path) for name, path in TRANSACTION_FIELDS.items()]
+
+    def append(self, transaction):
+        for column, path in self._paths:
+            value = transaction
+            for key in path:
+                value = value.get(key) if isinstance(value, dict) else None
+            column.append(value)
+
+
+def read_transactions_frame(stream):
+    """Build the transactions frame from a JSON upload; see read_transaction_columns()."""
+    return _columns_frame(read_transaction_columns(stream))
+
+
+def read_transaction_columns(stream):
+    """TRANSACTION_FIELDS column lists of a JSON upload, read without loading the whole document.
+
+    `transactions.booked[]` is read item by item with ijson.items() and
+    written straight into column buffers; the stream is then rewound and
+    `transactions.pending[]` read the same way, so booked rows come before
+    pending ones, as in analyze_transactions. Without ijson, or for a
+    document ijson rejects (e.g. one with NaN literals), the whole document
+    is decoded with app.json.loads(), which raises json.JSONDecodeError for
+    malformed JSON.
+    """
+    if ijson is not None:
+        buffer = _ColumnBuffer()
+        try:
+            for item_prefix in ("transactions.booked.item", "transactions.pending.item"):
+                stream.seek(0)
+                for transaction in ijson.items(stream, item_prefix, use_float=True):
+                    buffer.append(transaction)
+            return buffer.columns
+        except ijson.JSONError:
+            stream.seek(0)
+    return payload_columns(app.json.loads(stream.read()))
 
-def analyze_transactions(data):
-    data = fix_nan(data)
 
+def payload_columns(data):
+    """TRANSACTION_FIELDS column lists of a decoded payload, booked rows first."""
     booked = data.get("transactions", {}).get("booked", [])
     pending = data.get("transactions", {}).get("pending", [])
-    all_transactions = booked + pending
+    return transaction_columns(booked + pending)
 
-    df = pd.json_normalize(all_transactions)
 
-    if df.empty:
-        return {"error": "No transactions found"}
+def payload_frame(data):
+    """Transactions frame of a decoded payload, booked rows first."""
+    return _columns_frame(payload_columns(data))
+
+
+def analyze_transactions(data, **options):
+    return analyze_columns(payload_columns(data), **options)
+
+
+def analyze_columns(columns, engine=None, **options):
+    """Run the analysis over TRANSACTION_FIELDS column lists on the chosen engine.
+
+    `engine` is one of ENGINES. Without one, statements under
+    SMALL_STATEMENT_ROWS go through analyze_small() and the rest through
+    ANALYSIS_ENGINE.
+    """
+    if engine is None:
+        rows = len(next(iter(columns.values()), []))
+        engine = "numpy" if rows < SMALL_STATEMENT_ROWS else ANALYSIS_ENGINE
+    if engine == "numpy":
+        return analyze_small(columns, **options)
+    if engine == "polars":
+        return analyze_polars(columns, **options)
+    if engine == "duckdb":
+        return analyze_duckdb(columns, **options)
+    if engine == "sharded":
+        return analyze_sharded(_columns_frame(columns), **options)
+    return analyze_frame(_columns_frame(columns), **options)
+
 
+# Секции на резултата и кои от тях се нуждаят от контрагент / статистики по контрагент
+SECTIONS = (
+    "summary",
+    "daily_totals",
+    "top_debtors",
+    "payment_frequency",
+    "potential_duplicates",
+    "outliers",
+    "behavioral_profiles",
+    "transaction_count",
+)
+COUNTERPARTY_SECTIONS = {"top_debtors", "payment_frequency", "potential_duplicates", "outliers", "behavioral_profiles"}
+STATISTICS_SECTIONS = {"payment_frequency", "outliers", "behavioral_profiles"}
+
+
+def prepare_transactions(df):
+    """Add the typed amount, currency and bookingDate columns the analysis works on."""
     df["amount"] = pd.to_numeric(df.get("transactionAmount.amount", 0), errors="coerce").fillna(0)
     df["currency"] = df.get("transactionAmount.currency", "BGN")
     df["bookingDate"] = pd.to_datetime(df.get("bookingDate"), errors="coerce")
-    df["type"] = df["amount"].apply(lambda x: "income" if x > 0 else "expense")
+
+
+def load_fx_rates(path):
+    """FX table from a CSV with date, currency and rate columns, sorted by date.
+
+    `rate` is the value of one unit of `currency` in FX_BASE_CURRENCY on
+    `date`; it holds until the next date listed for that currency.
+    """
+    rates = pd.read_csv(path, usecols=["date", "currency", "rate"], dtype={"currency": object, "rate": float})
+    rates["date"] = pd.to_datetime(rates["date"]).astype("datetime64[ns]")
+    return rates.dropna().sort_values("date", kind="stable").reset_index(drop=True)
+
+
+# Локална таблица с курсове за превалутиране на сумите в ?reporting_currency=
+FX_BASE_CURRENCY = os.environ.get("FX_BASE_CURRENCY", "EUR")
+FX_RATES_PATH = os.environ.get("FX_RATES_PATH")
+if FX_RATES_PATH:
+    FX_RATES = load_fx_rates(FX_RATES_PATH)
+    with open(FX_RATES_PATH, "rb") as fx_file:
+        FX_RATES_VERSION = hashlib.sha256(fx_file.read()).hexdigest()
+else:
+    FX_RATES = pd.DataFrame({
+        "date": pd.Series(dtype="datetime64[ns]"),
+        "currency": pd.Series(dtype=object),
+        "rate": pd.Series(dtype=float),
+    })
+    FX_RATES_VERSION = None
+
+SUMMARY_TOTALS = ("total_income", "total_expense", "net_result")
+
+
+def fx_rates_asof(dates, currencies, rates=None):
+    """Rate in FX_BASE_CURRENCY of every (date, currency) pair, as of that date.
+
+    All pairs are matched against the table with one merge_asof on the date,
+    taking the latest rate on or before it. FX_BASE_CURRENCY is always 1;
+    pairs without a date or an earlier rate get NaN.
+    """
+    rates = FX_RATES if rates is None else rates
+    currencies = np.asarray(currencies, dtype=object)
+    query = pd.DataFrame({
+        "date": np.asarray(dates, dtype="datetime64[ns]"),
+        "currency": currencies,
+        "row": np.arange(len(currencies)),
+    }).dropna().sort_values("date", kind="stable")
+    joined = pd.merge_asof(
+        query.astype({"currency": object}), rates.astype({"currency": object}), on="date", by="currency", direction="backward"
+    )
+
+    result = np.full(len(currencies), np.nan)
+    result[joined["row"].to_numpy()] = joined["rate"].to_numpy()
+    result[currencies == FX_BASE_CURRENCY] = 1.0
+    return result
+
+
+def currency_summaries(amounts, currencies, dates, groups, reporting_currency=None, rates=None):
+    """Currency-aware summary fields for every group, keyed by group number.
+
+    `by_currency` holds the totals of each currency on its own. With a
+    `reporting_currency`, every amount is converted at its booking date's
+    rate (see fx_rates_asof) and the converted totals replace the plain
+    ones; transactions that cannot be converted are left out and counted in
+    `unconverted_count`.
+    """
+    amounts = pd.Series(np.asarray(amounts, dtype=float))
+    income = amounts > 0
+    frame = pd.DataFrame({
+        "total_income": amounts.where(income, 0),
+        "total_expense": amounts.where(~income, 0),
+        "net_result": amounts,
+    })
+    return _currency_totals(frame, np.ones(len(frame)), currencies, dates, groups, reporting_currency, rates)
+
+
+def _currency_totals(frame, counts, currencies, dates, groups, reporting_currency=None, rates=None):
+    """currency_summaries() over pre-aggregated rows.
+
+    Every row of `frame` holds SUMMARY_TOTALS for one (currency, date) and
+    `counts` the number of transactions behind it.
+    """
+    counts = pd.Series(np.asarray(counts, dtype=np.int64))
+    groups = pd.Series(np.asarray(groups, dtype=np.int64))
+    currencies = pd.Series(np.asarray(currencies, dtype=object))
+
+    summaries = {group: {"by_currency": {}} for group in groups.unique()}
+    by_currency = frame.groupby([groups, currencies]).sum().round(2)
+    for (group, currency), totals in by_currency.to_dict("index").items():
+        summaries[group]["by_currency"][currency] = totals
+
+    if reporting_currency:
+        # курс към отчетната валута = курс на валутата / курс на отчетната валута към същата дата
+        factor = fx_rates_asof(dates, currencies, rates) / fx_rates_asof(dates, [reporting_currency] * len(frame), rates)
+        factor[(currencies == reporting_currency).to_numpy()] = 1.0
+        convertible = pd.Series(np.isfinite(factor))
+        converted = frame[convertible].mul(factor[convertible.to_numpy()], axis=0).groupby(groups[convertible]).sum()
+        unconverted = counts.where(~convertible, 0).groupby(groups).sum()
+        for group, summary in summaries.items():
+            totals = converted.loc[group] if group in converted.index else pd.Series(0.0, index=SUMMARY_TOTALS)
+            summary.update({name: round(totals[name], 2) for name in SUMMARY_TOTALS})
+            summary["currency"] = reporting_currency
+            summary["unconverted_count"] = int(unconverted[group])
+    return summaries
+
+
+def currency_summary(amounts, currencies, dates, reporting_currency=None, rates=None):
+    """currency_summaries() of a single statement."""
+    return currency_summaries(amounts, currencies, dates, np.zeros(len(amounts)), reporting_currency, rates)[0]
+
+
+def payment_frequency(stats):
+    """Average days between payments for counterparties with at least two dated ones."""
+    return stats.loc[stats["date_count"] > 1, "interval_mean"].round(2).to_dict()
+
+
+def behavioral_profiles(stats):
+    """Per-counterparty behaviour profile built from the shared statistics table."""
+    mean_amount = stats["mean"]
+    avg_interval = stats["interval_mean"].round(2)
+    volatility = (stats["std"] / mean_amount).abs().where(mean_amount != 0, 0)
+    irregularity = (stats["interval_std"] / avg_interval).where(avg_interval > 0, 0)
+    risk = (volatility + irregularity) * 50
+
+    profiles = pd.DataFrame({
+        "avg_amount": mean_amount.round(2),
+        "consistency": (stats["std"] / mean_amount).round(2).astype(object).where(
+            (mean_amount != 0) & stats["std"].notna(), None
+        ),
+        "avg_interval_days": avg_interval.astype(object).where(avg_interval.notna(), None),
+        "trend": np.where(
+            stats["count"] >= 2, np.where(stats["slope"] > 0, "increasing", "decreasing"), "stable"
+        ),
+        "most_active_day": stats["most_active_day"].astype(object).where(stats["most_active_day"].notna(), None),
+        # min(100, ...) и за NaN дава 100
+        "risk_score": risk.where(risk < 100, 100).round(2),
+    }, index=stats.index)
+    return profiles.to_dict("index")
+
+
+def analyze_frame(
+    df,
+    sections=None,
+    duplicate_window_days=None,
+    amount_tolerance=0.0,
+    remittance_prefixes=REMITTANCE_PREFIXES,
+    reporting_currency=None,
+):
+    """Analyze a transactions frame, computing only `sections` (all of SECTIONS by default).
+
+    Counterparty resolution and the per-counterparty statistics pass only
+    run when a requested section depends on them.
+    """
+    if df.empty:
+        return {"error": "No transactions found"}
+
+    wanted = set(SECTIONS if sections is None else sections)
+
+    prepare_transactions(df)
 
     # 🧭 Определяне на контрагента
-    df["counterparty"] = None
-    for i, row in df.iterrows():
-        amount = row.get("amount", 0)
-        creditor = row.get("creditorName")
-        debtor = row.get("debtorName")
-        remittance = row.get("remittanceInformationUnstructured", "")
-
-        counterparty = None
-
-        if amount > 0:
-            # входящ превод
-            if pd.notna(debtor) and str(debtor).strip():
-                counterparty = debtor
-            elif pd.notna(creditor) and str(creditor).strip():
-                counterparty = creditor
-        elif amount < 0:
-            # изходящ превод
-            if pd.notna(creditor) and str(creditor).strip():
-                counterparty = creditor
-            elif pd.notna(debtor) and str(debtor).strip():
-                counterparty = debtor
-
-        # ако няма контрагент, търсим в описанието
-        if not counterparty:
-            extracted = extract_azv_entities(remittance)
-            if extracted:
-                counterparty = extracted[0]
-
-        df.at[i, "counterparty"] = counterparty
+    if wanted & COUNTERPARTY_SECTIONS:
+        df["counterparty"] = resolve_counterparties(df, remittance_prefixes)
+
+    # --- 📐 Статистики по контрагент ---
+    stats = counterparty_statistics(df) if wanted & STATISTICS_SECTIONS else None
+
+    output = {}
 
     # --- 🧮 Финансови суми ---
-    total_income = df[df["type"] == "income"]["amount"].sum()
-    total_expense = df[df["type"] == "expense"]["amount"].sum()
-    net_result = df["amount"].sum()
+    if "summary" in wanted:
+        income = df["amount"] > 0
+        output["summary"] = {
+            "total_income": round(df.loc[income, "amount"].sum(), 2),
+            "total_expense": round(df.loc[~income, "amount"].sum(), 2),
+            "net_result": round(df["amount"].sum(), 2),
+            "currency": df["currency"].iloc[0] if not df.empty else "BGN",
+            **currency_summary(df["amount"], df["currency"], df["bookingDate"], reporting_currency),
+        }
 
     # --- 📅 Дневни обобщения ---
-    daily_summary = (
-        df.groupby(df["bookingDate"].dt.strftime("%Y-%m-%d"))["amount"].sum().sort_index().to_dict()
-        if "bookingDate" in df.columns
-        else {}
-    )
+    if "daily_totals" in wanted:
+        output["daily_totals"] = (
+            df.groupby(df["bookingDate"].dt.strftime("%Y-%m-%d"))["amount"].sum().sort_index().to_dict()
+        )
 
     # --- 💰 Топ контрагенти ---
-    top_counterparties = (
-        df.groupby("counterparty")["amount"].sum().sort_values(ascending=False).head(5).to_dict()
-        if "counterparty" in df.columns
-        else {}
-    )
+    if "top_debtors" in wanted:
+        output["top_debtors"] = (
+            df.groupby("counterparty")["amount"].sum().sort_values(ascending=False).head(5).to_dict()
+        )
 
     # --- 🔁 Честота на плащания ---
-    payment_frequency = {}
-    if "counterparty" in df.columns and "bookingDate" in df.columns:
-        for debtor, group in df.groupby("counterparty"):
-            dates = group["bookingDate"].dropna().sort_values()
-            if len(dates) > 1:
-                diffs = dates.diff().dropna().dt.days
-                payment_frequency[debtor] = round(diffs.mean(), 2)
+    if "payment_frequency" in wanted:
+        output["payment_frequency"] = payment_frequency(stats)
 
     # --- 🔍 Дублиращи се плащания ---
-    duplicate_candidates = df.groupby(
-        ["counterparty", "transactionAmount.amount", "transactionAmount.currency"]
-    ).filter(lambda g: len(g) > 1)
-
-    potential_duplicates = []
-    if not duplicate_candidates.empty:
-        for _, row in duplicate_candidates.iterrows():
-            potential_duplicates.append({
-                "bookingDate": row.get("bookingDate").strftime("%Y-%m-%d") if pd.notna(row.get("bookingDate")) else None,
-                "counterparty": row.get("counterparty"),
-                "amount": row.get("transactionAmount.amount"),
-                "currency": row.get("transactionAmount.currency"),
-                "iban": row.get("creditorAccount.iban"),
-                "remittance": row.get("remittanceInformationUnstructured")
-            })
+    if "potential_duplicates" in wanted:
+        if duplicate_window_days is None:
+            output["potential_duplicates"] = find_duplicates(df)
+        else:
+            output["potential_duplicates"] = find_near_duplicates(df, duplicate_window_days, amount_tolerance)
 
     # --- ⚠️ Outlier detection ---
-    outliers = []
-    if "counterparty" in df.columns:
-        for debtor, group in df.groupby("counterparty"):
-            if len(group) > 2:
-                mean = group["amount"].mean()
-                std = group["amount"].std(ddof=0)
-                if std > 0:
-                    group["z_score"] = (group["amount"] - mean) / std
-                    for _, row in group.iterrows():
-                        if abs(row["z_score"]) > 2.5:
-                            outliers.append({
-                                "counterparty": debtor,
-                                "amount": row["amount"],
-                                "mean": round(mean, 2),
-                                "std_dev": round(std, 2),
-                                "z_score": round(row["z_score"], 2),
-                                "currency": row.get("currency"),
-                                "bookingDate": row.get("bookingDate").strftime("%Y-%m-%d") if pd.notna(row.get("bookingDate")) else None,
-                                "reason": "Unusually high transaction amount" if row["z_score"] > 0 else "Unusually low transaction amount"
-                            })
+    if "outliers" in wanted:
+        output["outliers"] = detect_outliers(df, stats)
 
     # --- 🧭 Поведенчески профили ---
-    behavioral_profiles = {}
-    if "counterparty" in df.columns and "bookingDate" in df.columns:
-        for debtor, group in df.groupby("counterparty"):
-            group = group.sort_values("bookingDate")
-            mean_amount = group["amount"].mean()
-            std_amount = group["amount"].std()
-            consistency = round(std_amount / mean_amount, 2) if mean_amount != 0 else None
-
-            diffs = group["bookingDate"].diff().dropna().dt.days
-            avg_interval = round(diffs.mean(), 2) if len(diffs) > 0 else None
-
-            if len(group) >= 2:
-                trend = np.polyfit(range(len(group)), group["amount"], 1)[0]
-                trend_label = "increasing" if trend > 0 else "decreasing"
+    if "behavioral_profiles" in wanted:
+        output["behavioral_profiles"] = behavioral_profiles(stats)
+
+    if "transaction_count" in wanted:
+        output["transaction_count"] = len(df)
+
+    return output
+
+
+# Имената на дните по азбучен ред, за да се решава равенство като Series.mode()
+WEEKDAYS = ("Friday", "Monday", "Saturday", "Sunday", "Thursday", "Tuesday", "Wednesday")
+
+
+class AccountState:
+    """Running aggregates of one account, updated with only its new transactions.
+
+    Keeps the summary totals, daily buckets, per-(currency, day) totals
+    and, per counterparty, Welford amount moments, booking interval sums,
+    weekday counts and the trend sums, so `result()` matches analyze_frame() on the concatenation of
+    every update (up to floating-point rounding) for its SECTIONS.
+    Outliers and duplicates need the individual transactions and are not
+    kept. Updates must be append-only in time: a transaction booked before
+    its counterparty's latest stored booking raises ValueError, after which
+    the account has to be rebuilt from its full history.
+    """
+
+    SECTIONS = ("summary", "daily_totals", "top_debtors", "payment_frequency", "behavioral_profiles", "transaction_count")
+    NUMERIC = (
+        "count", "total", "mean", "m2", "date_count", "first_day", "last_day",
+        "interval_count", "interval_sum", "interval_sumsq", "dated_sum", "dated_weighted_sum",
+    ) + WEEKDAYS
+    # всички освен първия/последния ден имат смислена нула за липсващ контрагент
+    ZERO_FILLED = [name for name in NUMERIC if name not in ("first_day", "last_day")]
+
+    def __init__(self, remittance_prefixes=REMITTANCE_PREFIXES):
+        self.remittance_prefixes = tuple(remittance_prefixes)
+        self.totals = {"count": 0, "income": 0.0, "expense": 0.0, "net": 0.0, "currency": None}
+        self.daily = {}
+        # (валута, ден) -> [приходи, разходи, нето, брой], за by_currency и превалутирането
+        self.currency_days = {}
+        self.counterparties = self._table()
+
+    @classmethod
+    def _table(cls, rows=None, index=None):
+        table = pd.DataFrame(rows, index=index, columns=list(cls.NUMERIC) + ["undated"])
+        table = table.astype({name: float for name in cls.NUMERIC})
+        table.index.name = "counterparty"
+        return table
+
+    def update(self, df):
+        """Fold a frame of new transactions (as built by build_transactions_frame) into the state."""
+        if df.empty:
+            return
+        prepare_transactions(df)
+        df["counterparty"] = resolve_counterparties(df, self.remittance_prefixes)
+
+        batch = self._aggregate(df)
+        merged = self._merge(self.counterparties, batch)
+
+        amount = df["amount"]
+        if self.totals["count"] == 0:
+            currency = df["currency"].iloc[0]
+            self.totals["currency"] = currency if pd.notna(currency) else None
+        self.totals["count"] += len(df)
+        self.totals["income"] += float(amount[amount > 0].sum())
+        self.totals["expense"] += float(amount[amount <= 0].sum())
+        self.totals["net"] += float(amount.sum())
+        for day, total in df.groupby(df["bookingDate"].dt.strftime("%Y-%m-%d"))["amount"].sum().items():
+            self.daily[day] = self.daily.get(day, 0.0) + float(total)
+        buckets = pd.DataFrame({
+            "income": amount.where(amount > 0, 0),
+            "expense": amount.where(amount <= 0, 0),
+            "net": amount,
+            "count": 1,
+        }).groupby([df["currency"], df["bookingDate"].dt.strftime("%Y-%m-%d")], dropna=False).sum()
+        for (currency, day), income, expense, net, count in buckets.itertuples(name=None):
+            key = (None if pd.isna(currency) else currency, None if pd.isna(day) else day)
+            bucket = self.currency_days.setdefault(key, [0.0, 0.0, 0.0, 0])
+            bucket[0] += float(income)
+            bucket[1] += float(expense)
+            bucket[2] += float(net)
+            bucket[3] += int(count)
+        self.counterparties = merged
+
+    def _aggregate(self, df):
+        """Per-counterparty aggregates of one batch, in the state table layout."""
+        rows = df[df["counterparty"].notna()].sort_values(["counterparty", "bookingDate"], kind="stable")
+        rows = rows.assign(day=(rows["bookingDate"] - pd.Timestamp(0)).dt.days)
+        grouped = rows.groupby("counterparty")["amount"]
+        batch = grouped.agg(count="size", total="sum", mean="mean")
+        batch["m2"] = grouped.var(ddof=0) * batch["count"]
+
+        dated = rows[rows["day"].notna()]
+        by_counterparty = dated.groupby("counterparty")
+        dated = dated.assign(
+            position=by_counterparty.cumcount(),
+            interval=by_counterparty["day"].diff(),
+            weekday=dated["bookingDate"].dt.day_name(),
+        )
+        dated = dated.assign(weighted=dated["position"] * dated["amount"], interval_sq=dated["interval"] ** 2)
+        batch = batch.join(dated.groupby("counterparty").agg(
+            date_count=("day", "size"),
+            first_day=("day", "min"),
+            last_day=("day", "max"),
+            interval_count=("interval", "count"),
+            interval_sum=("interval", "sum"),
+            interval_sumsq=("interval_sq", "sum"),
+            dated_sum=("amount", "sum"),
+            dated_weighted_sum=("weighted", "sum"),
+        ))
+        batch = batch.join(pd.crosstab(dated["counterparty"], dated["weekday"]).reindex(columns=WEEKDAYS, fill_value=0))
+
+        batch[self.ZERO_FILLED] = batch[self.ZERO_FILLED].fillna(0)
+        undated = rows[rows["day"].isna()].groupby("counterparty")["amount"].agg(list)
+        batch["undated"] = [undated.get(name, []) for name in batch.index]
+        return self._table(batch, index=batch.index)
+
+    def _merge(self, state, batch):
+        """Combine two state tables (Chan's parallel form of Welford's update)."""
+        common = state.index.intersection(batch.index)
+        late = batch.loc[common, "first_day"] < state.loc[common, "last_day"]
+        if late.any():
+            raise ValueError(
+                f"Transactions with {', '.join(map(str, late[late].index[:5]))} are older than the stored history"
+            )
+
+        index = state.index.union(batch.index)
+        a = state.reindex(index)
+        b = batch.reindex(index)
+        a[self.ZERO_FILLED] = a[self.ZERO_FILLED].fillna(0)
+        b[self.ZERO_FILLED] = b[self.ZERO_FILLED].fillna(0)
+
+        merged = self._table(index=index)
+        n = a["count"] + b["count"]
+        delta = b["mean"] - a["mean"]
+        merged["count"] = n
+        merged["total"] = a["total"] + b["total"]
+        merged["mean"] = a["mean"] + delta * b["count"] / n
+        merged["m2"] = a["m2"] + b["m2"] + delta ** 2 * a["count"] * b["count"] / n
+
+        # интервалът между последното запазено и първото ново плащане
+        bridge = (b["first_day"] - a["last_day"]).fillna(0)
+        bridged = a["last_day"].notna() & b["first_day"].notna()
+        merged["interval_count"] = a["interval_count"] + b["interval_count"] + bridged
+        merged["interval_sum"] = a["interval_sum"] + b["interval_sum"] + bridge
+        merged["interval_sumsq"] = a["interval_sumsq"] + b["interval_sumsq"] + bridge ** 2
+
+        merged["date_count"] = a["date_count"] + b["date_count"]
+        merged["first_day"] = a["first_day"].fillna(b["first_day"])
+        merged["last_day"] = b["last_day"].fillna(a["last_day"])
+        merged["dated_sum"] = a["dated_sum"] + b["dated_sum"]
+        merged["dated_weighted_sum"] = a["dated_weighted_sum"] + b["dated_weighted_sum"] + a["date_count"] * b["dated_sum"]
+        for weekday in WEEKDAYS:
+            merged[weekday] = a[weekday] + b[weekday]
+        merged["undated"] = [
+            (x if isinstance(x, list) else []) + (y if isinstance(y, list) else [])
+            for x, y in zip(a["undated"], b["undated"])
+        ]
+        return merged
+
+    def statistics(self):
+        """The counterparty_statistics() table reconstructed from the running aggregates."""
+        table = self.counterparties.sort_index()
+        count = table["count"]
+        interval_count = table["interval_count"]
+        interval_var = (table["interval_sumsq"] - table["interval_sum"] ** 2 / interval_count) / (interval_count - 1)
+
+        # плащанията без дата са последни в подредбата по дата
+        undated_sum = pd.Series([sum(amounts) for amounts in table["undated"]], index=table.index)
+        undated_weighted = pd.Series(
+            [sum((start + j) * y for j, y in enumerate(amounts)) for start, amounts in zip(table["date_count"], table["undated"])],
+            index=table.index,
+        )
+        weekdays = table[list(WEEKDAYS)]
+
+        return pd.DataFrame({
+            "count": count,
+            "mean": table["mean"],
+            "std": np.sqrt((table["m2"] / (count - 1)).clip(lower=0)).where(count > 1),
+            "std_pop": np.sqrt((table["m2"] / count).clip(lower=0)),
+            "date_count": table["date_count"],
+            "interval_mean": (table["interval_sum"] / interval_count).where(interval_count > 0),
+            "interval_std": np.sqrt(interval_var.clip(lower=0)).where(interval_count > 1),
+            "slope": _trend_slope(
+                count, table["dated_sum"] + undated_sum, table["dated_weighted_sum"] + undated_weighted
+            ),
+            "most_active_day": weekdays.idxmax(axis=1).where(weekdays.max(axis=1) > 0),
+        }, index=table.index)
+
+    def result(self, sections=None, reporting_currency=None):
+        """Analysis output for SECTIONS, in the same shape as analyze_frame()."""
+        if self.totals["count"] == 0:
+            return {"error": "No transactions found"}
+
+        wanted = set(self.SECTIONS if sections is None else sections)
+        stats = self.statistics() if wanted & STATISTICS_SECTIONS else None
+        output = {}
+        if "summary" in wanted:
+            output["summary"] = {
+                "total_income": round(self.totals["income"], 2),
+                "total_expense": round(self.totals["expense"], 2),
+                "net_result": round(self.totals["net"], 2),
+                "currency": self.totals["currency"],
+            }
+            keys = list(self.currency_days)
+            buckets = np.array(list(self.currency_days.values()), dtype=float).reshape(-1, 4)
+            output["summary"].update(_currency_totals(
+                pd.DataFrame(buckets[:, :3], columns=SUMMARY_TOTALS),
+                buckets[:, 3],
+                [currency for currency, _ in keys],
+                pd.to_datetime(pd.Series([day for _, day in keys], dtype=object)),
+                np.zeros(len(keys)),
+                reporting_currency,
+            ).get(0, {"by_currency": {}}))
+        if "daily_totals" in wanted:
+            output["daily_totals"] = dict(sorted(self.daily.items()))
+        if "top_debtors" in wanted:
+            totals = self.counterparties["total"].sort_index()
+            output["top_debtors"] = totals.sort_values(ascending=False).head(5).to_dict()
+        if "payment_frequency" in wanted:
+            output["payment_frequency"] = payment_frequency(stats)
+        if "behavioral_profiles" in wanted:
+            output["behavioral_profiles"] = behavioral_profiles(stats)
+        if "transaction_count" in wanted:
+            output["transaction_count"] = self.totals["count"]
+        return output
+
+    def to_json(self):
+        table = self.counterparties
+        return app.json.dumps({
+            "remittance_prefixes": self.remittance_prefixes,
+            "totals": self.totals,
+            "daily": self.daily,
+            "currency_days": [[*key, *bucket] for key, bucket in self.currency_days.items()],
+            "counterparties": {
+                "index": table.index.tolist(),
+                "columns": table.columns.tolist(),
+                "data": table.to_numpy(dtype=object).tolist(),
+            },
+        })
+
+    @classmethod
+    def from_json(cls, blob):
+        data = app.json.loads(blob)
+        state = cls(data["remittance_prefixes"])
+        state.totals = data["totals"]
+        state.daily = data["daily"]
+        state.currency_days = {
+            (currency, day): [income, expense, net, count]
+            for currency, day, income, expense, net, count in data.get("currency_days", [])
+        }
+        table = data["counterparties"]
+        rows = pd.DataFrame(table["data"], index=table["index"], columns=table["columns"], dtype=object)
+        state.counterparties = cls._table(rows, index=rows.index)
+        return state
+
+
+class StateStore:
+    """Persists serialized AccountState blobs by account id.
+
+    Uses Redis when `client` (any redis-py compatible client) is given, so
+    every gunicorn worker sees the same accounts; otherwise keeps them in
+    process memory.
+    """
+
+    # Брой ключалки, между които се разпределят сметките при update()
+    LOCK_STRIPES = 64
+
+    def __init__(self, client=None, prefix="account:"):
+        self.client = client
+        self.prefix = prefix
+        self._blobs = {}
+        self._lock = threading.Lock()
+        self._update_locks = [threading.Lock() for _ in range(self.LOCK_STRIPES)]
+
+    def get(self, account_id):
+        if self.client is not None:
+            return self.client.get(self.prefix + account_id)
+        with self._lock:
+            return self._blobs.get(account_id)
+
+    def set(self, account_id, blob):
+        if self.client is not None:
+            self.client.set(self.prefix + account_id, blob)
+            return
+        with self._lock:
+            self._blobs[account_id] = blob
+
+    def update(self, account_id, change):
+        """Atomically replace an account's blob with the one `change` computes from it.
+
+        `change(blob)` receives the stored blob (None for a new account) and
+        returns (new_blob, value); update() stores new_blob and returns value.
+        On Redis the read and write run under WATCH/MULTI and `change` is
+        retried when another worker wrote the account in between; locally
+        the account's lock is held for the whole update. Exceptions from
+        `change` leave the stored blob untouched.
+        """
+        if self.client is not None:
+            key = self.prefix + account_id
+            with self.client.pipeline() as pipe:
+                while True:
+                    try:
+                        pipe.watch(key)
+                        blob, value = change(pipe.get(key))
+                        pipe.multi()
+                        pipe.set(key, blob)
+                        pipe.execute()
+                        return value
+                    except redis.WatchError:
+                        continue  # сметката е променена междувременно, започваме отначало
+
+        with self._update_locks[hash(account_id) % self.LOCK_STRIPES]:
+            blob, value = change(self.get(account_id))
+            self.set(account_id, blob)
+            return value
+
+    def delete(self, account_id):
+        if self.client is not None:
+            return bool(self.client.delete(self.prefix + account_id))
+        with self._lock:
+            return self._blobs.pop(account_id, None) is not None
+
+
+# Изпълнители на анализа; по подразбиране от ANALYSIS_ENGINE, иначе ?engine=
+ENGINES = ("numpy",) + tuple(
+    name for name, module in (("pandas", pd), ("sharded", pd), ("polars", pl), ("duckdb", duckdb)) if module is not None
+)
+ANALYSIS_ENGINE = os.environ.get("ANALYSIS_ENGINE", "pandas")
+if ANALYSIS_ENGINE not in ENGINES:
+    raise RuntimeError(f"ANALYSIS_ENGINE={ANALYSIS_ENGINE!r} is not one of the available engines: {', '.join(ENGINES)}")
+# Под този брой транзакции анализът минава през "numpy" изпълнителя, освен ако не е избран друг
+SMALL_STATEMENT_ROWS = int(os.environ.get("SMALL_STATEMENT_ROWS", 200))
+
+
+def _is_missing(value):
+    return value is None or (isinstance(value, float) and math.isnan(value))
+
+
+def _has_text_value(value):
+    return not _is_missing(value) and bool(str(value).strip())
+
+
+def _round(value):
+    """round(x, 2) with NumPy's rounding, as pandas results get it."""
+    return round(np.float64(value), 2)
+
+
+def _summary_totals(amounts):
+    """SUMMARY_TOTALS of a sequence of amounts, as the pandas summary rounds them."""
+    return {
+        "total_income": _round(math.fsum(amount for amount in amounts if amount > 0)),
+        "total_expense": _round(math.fsum(amount for amount in amounts if amount <= 0)),
+        "net_result": _round(math.fsum(amounts)),
+    }
+
+
+def _profile(count, mean, std, interval_mean, interval_std, slope, most_active_day):
+    """Scalar form of one behavioral_profiles() row."""
+    avg_interval = _round(interval_mean) if not math.isnan(interval_mean) else None
+    volatility = abs(std / mean) if mean != 0 else 0
+    irregularity = (interval_std / avg_interval) if avg_interval and avg_interval > 0 else 0
+    return {
+        "avg_amount": _round(mean),
+        "consistency": _round(std / mean) if mean != 0 and not math.isnan(std) else None,
+        "avg_interval_days": avg_interval,
+        "trend": ("increasing" if slope > 0 else "decreasing") if count >= 2 else "stable",
+        "most_active_day": most_active_day,
+        "risk_score": _round(min(100, (volatility + irregularity) * 50)),
+    }
+
+
+def analyze_small(
+    columns,
+    sections=None,
+    duplicate_window_days=None,
+    amount_tolerance=0.0,
+    remittance_prefixes=REMITTANCE_PREFIXES,
+    reporting_currency=None,
+):
+    """analyze_frame() for small statements with plain lists, dicts and NumPy arrays.
+
+    Skips DataFrame construction and groupby setup, which dominate the cost
+    of statements with a few hundred transactions; amounts and dates are
+    still parsed with pd.to_numeric / pd.to_datetime so every value means
+    the same as on the pandas path.
+    """
+    columns = {name: values for name, values in columns.items() if any(value is not None for value in values)}
+    if not columns:
+        return {"error": "No transactions found"}
+
+    n = len(next(iter(columns.values())))
+    missing = [None] * n
+    raw_amount = columns.get("transactionAmount.amount", missing)
+    raw_currency = columns.get("transactionAmount.currency", missing)
+    amounts = np.nan_to_num(pd.to_numeric(pd.Series(raw_amount, dtype=object), errors="coerce").to_numpy(float), nan=0.0)
+    currency = raw_currency if "transactionAmount.currency" in columns else ["BGN"] * n
+    dates = pd.to_datetime(pd.Series(columns.get("bookingDate", missing), dtype=object), errors="coerce")
+    days = [None if pd.isna(date) else date for date in dates]
+
+    wanted = set(SECTIONS if sections is None else sections)
+    output = {}
+
+    # 🧭 Определяне на контрагента
+    counterparty = missing
+    if wanted & COUNTERPARTY_SECTIONS:
+        pattern = remittance_pattern(tuple(remittance_prefixes)) if remittance_prefixes else None
+        creditors = columns.get("creditorName", missing)
+        debtors = columns.get("debtorName", missing)
+        remittances = columns.get("remittanceInformationUnstructured", missing)
+        counterparty = []
+        for amount, creditor, debtor, remittance in zip(amounts, creditors, debtors, remittances):
+            first, second = (debtor, creditor) if amount > 0 else (creditor, debtor)
+            if amount != 0 and _has_text_value(first):
+                name = first
+            elif amount != 0 and _has_text_value(second):
+                name = second
             else:
-                trend_label = "stable"
+                match = pattern.search(remittance) if pattern is not None and isinstance(remittance, str) else None
+                name = match.group(1).strip() if match else None
+            counterparty.append(name)
+
+    # --- 🧮 Финансови суми ---
+    if "summary" in wanted:
+        output["summary"] = {**_summary_totals(amounts), "currency": currency[0]}
+        if reporting_currency:
+            output["summary"].update(currency_summary(amounts, currency, dates, reporting_currency))
+        else:
+            by_currency = {}
+            for amount, code in zip(amounts, currency):
+                if not _is_missing(code):
+                    by_currency.setdefault(code, []).append(amount)
+            output["summary"]["by_currency"] = {
+                code: _summary_totals(by_currency[code]) for code in sorted(by_currency)
+            }
+
+    # --- 📅 Дневни обобщения ---
+    if "daily_totals" in wanted:
+        daily = {}
+        for date, amount in zip(days, amounts):
+            if date is not None:
+                daily.setdefault(date.strftime("%Y-%m-%d"), []).append(amount)
+        output["daily_totals"] = {day: math.fsum(values) for day, values in sorted(daily.items())}
+
+    groups = {}
+    for i, name in enumerate(counterparty):
+        if name is not None:
+            groups.setdefault(name, []).append(i)
+    groups = dict(sorted(groups.items()))
+
+    # --- 💰 Топ контрагенти ---
+    if "top_debtors" in wanted:
+        totals = {name: math.fsum(amounts[rows]) for name, rows in groups.items()}
+        output["top_debtors"] = dict(sorted(totals.items(), key=lambda item: -item[1])[:5])
+
+    # --- 📐 Статистики по контрагент ---
+    stats = {}
+    if wanted & STATISTICS_SECTIONS:
+        for name, rows in groups.items():
+            # без дата - най-накрая, както sort_values(na_position="last")
+            rows = sorted(rows, key=lambda i: (days[i] is None, days[i] or 0, i))
+            values = amounts[rows]
+            dated = [days[i] for i in rows if days[i] is not None]
+            intervals = np.array([(b - a).days for a, b in zip(dated, dated[1:])], dtype=float)
+            weekdays = [date.day_name() for date in dated]
+            count = len(rows)
+            x = np.arange(count)
+            stats[name] = {
+                "rows": sorted(rows),
+                "count": count,
+                "mean": math.fsum(values) / count,
+                "std": values.std(ddof=1) if count > 1 else math.nan,
+                "std_pop": values.std(),
+                "date_count": len(dated),
+                "interval_mean": math.fsum(intervals) / len(intervals) if len(intervals) else math.nan,
+                "interval_std": intervals.std(ddof=1) if len(intervals) > 1 else math.nan,
+                "slope": (x @ values - (count - 1) / 2 * values.sum()) / (count * (count * count - 1) / 12)
+                if count >= 2 else math.nan,
+                "most_active_day": min(set(weekdays), key=lambda day: (-weekdays.count(day), day)) if weekdays else None,
+            }
 
-            most_active_day = (
-                group["bookingDate"].dt.day_name().mode()[0]
-                if not group["bookingDate"].dt.day_name().empty
-                else None
+    # --- 🔁 Честота на плащания ---
+    if "payment_frequency" in wanted:
+        output["payment_frequency"] = {
+            name: _round(group["interval_mean"]) for name, group in stats.items() if group["date_count"] > 1
+        }
+
+    # --- 🔍 Дублиращи се плащания ---
+    if "potential_duplicates" in wanted:
+        if duplicate_window_days is None:
+            keys = [
+                (name, amount, cur) if not any(map(_is_missing, (name, amount, cur))) else None
+                for name, amount, cur in zip(counterparty, raw_amount, raw_currency)
+            ]
+            seen = {}
+            for key in keys:
+                if key is not None:
+                    seen[key] = seen.get(key, 0) + 1
+            flagged = [i for i, key in enumerate(keys) if key is not None and seen[key] > 1]
+        else:
+            exact = amount_tolerance <= 0
+            candidates = [
+                i for i in range(n)
+                if counterparty[i] is not None and not _is_missing(raw_currency[i]) and days[i] is not None
+            ]
+            key = (lambda i: (counterparty[i], raw_currency[i], amounts[i])) if exact else (
+                lambda i: (counterparty[i], raw_currency[i])
+            )
+            candidates.sort(key=lambda i: (key(i), days[i], i))
+            group_ids, previous = [], None
+            for i in candidates:
+                current = key(i)
+                group_ids.append(group_ids[-1] + (current != previous) if group_ids else 0)
+                previous = current
+            matches = _window_matches(
+                np.array(group_ids, dtype=np.int64),
+                np.array([days[i].to_datetime64() for i in candidates], dtype="datetime64[D]").astype(np.int64),
+                amounts[candidates],
+                duplicate_window_days,
+                amount_tolerance,
+            ) if candidates else []
+            flagged = sorted(i for i, match in zip(candidates, matches) if match)
+
+        ibans = columns.get("creditorAccount.iban", missing)
+        remittances = columns.get("remittanceInformationUnstructured", missing)
+        output["potential_duplicates"] = [{
+            "bookingDate": days[i].strftime("%Y-%m-%d") if days[i] is not None else None,
+            "counterparty": counterparty[i],
+            "amount": raw_amount[i],
+            "currency": raw_currency[i],
+            "iban": ibans[i],
+            "remittance": remittances[i],
+        } for i in flagged]
+
+    # --- ⚠️ Outlier detection ---
+    if "outliers" in wanted:
+        outliers = []
+        for name, group in stats.items():
+            if group["count"] <= 2 or not group["std_pop"] > 0:
+                continue
+            for i in group["rows"]:
+                z_score = (amounts[i] - group["mean"]) / group["std_pop"]
+                if abs(z_score) > 2.5:
+                    outliers.append({
+                        "counterparty": name,
+                        "amount": amounts[i],
+                        "mean": _round(group["mean"]),
+                        "std_dev": _round(group["std_pop"]),
+                        "z_score": _round(z_score),
+                        "currency": currency[i],
+                        "bookingDate": days[i].strftime("%Y-%m-%d") if days[i] is not None else None,
+                        "reason": "Unusually high transaction amount" if z_score > 0 else "Unusually low transaction amount"
+                    })
+        output["outliers"] = outliers
+
+    # --- 🧭 Поведенчески профили ---
+    if "behavioral_profiles" in wanted:
+        output["behavioral_profiles"] = {
+            name: _profile(
+                group["count"], group["mean"], group["std"], group["interval_mean"],
+                group["interval_std"], group["slope"], group["most_active_day"],
             )
+            for name, group in stats.items()
+        }
+
+    if "transaction_count" in wanted:
+        output["transaction_count"] = n
+
+    return output
+
+
+def _pl_column(df, name, dtype=None):
+    """Column `name` of a polars frame, or an all-null literal if absent."""
+    if name in df.columns:
+        return pl.col(name) if dtype is None else pl.col(name).cast(dtype, strict=False)
+    return pl.lit(None, dtype=dtype or pl.String)
+
+
+def _pl_has_text(expr):
+    return expr.is_not_null() & (expr.cast(pl.String).str.strip_chars() != "")
+
+
+def _pl_key(columns, name):
+    """Codes of a raw column's values, null where missing; values pandas considers equal share a code."""
+    if name not in columns:
+        return pl.lit(None, dtype=pl.Int64)
+    codes = pd.factorize(pd.Series(columns[name], dtype=object))[0]
+    return pl.Series(codes, dtype=pl.Int64).replace(-1, None)
+
+
+def _pl_records(frame):
+    """A small polars frame as a pandas one, without needing pyarrow."""
+    return pd.DataFrame(frame.to_dict(as_series=False))
+
+
+def analyze_polars(
+    columns,
+    sections=None,
+    duplicate_window_days=None,
+    amount_tolerance=0.0,
+    remittance_prefixes=REMITTANCE_PREFIXES,
+    reporting_currency=None,
+):
+    """Polars implementation of analyze_frame() over TRANSACTION_FIELDS column lists.
+
+    Per-transaction work - parsing, counterparty resolution, grouping and
+    the outlier/duplicate masks - is built as LazyFrame queries, and the
+    queries of all requested sections are collected together, so Polars
+    plans them as one and runs the shared preparation once on its
+    multi-threaded engine. The per-counterparty tables it produces are small
+    and are turned into output with the same helpers as the pandas path, so
+    both engines share one output contract. Booking dates are expected in
+    ISO format.
+    """
+    source = pl.DataFrame(
+        {name: values for name, values in columns.items() if any(value is not None for value in values)},
+        strict=False,
+    )
+    if source.height == 0:
+        return {"error": "No transactions found"}
+
+    wanted = set(SECTIONS if sections is None else sections)
+
+    prepared = source.lazy().with_row_index("row").with_columns(
+        amount=_pl_column(source, "transactionAmount.amount", pl.Float64).fill_nan(0).fill_null(0),
+        currency=_pl_column(source, "transactionAmount.currency") if "transactionAmount.currency" in source.columns else pl.lit("BGN"),
+        bookingDate=_pl_column(source, "bookingDate", pl.String).str.to_datetime(strict=False),
+    )
+
+    # 🧭 Определяне на контрагента
+    if wanted & COUNTERPARTY_SECTIONS:
+        creditor = _pl_column(source, "creditorName", pl.String)
+        debtor = _pl_column(source, "debtorName", pl.String)
+        incoming = pl.col("amount") > 0
+        outgoing = pl.col("amount") < 0
+        remittance = _pl_column(source, "remittanceInformationUnstructured", pl.String)
+        fallback = (
+            remittance.str.extract(remittance_pattern(tuple(remittance_prefixes)).pattern, 1).str.strip_chars()
+            if remittance_prefixes
+            else pl.lit(None, dtype=pl.String)
+        )
+        prepared = prepared.with_columns(
+            counterparty=pl.when(incoming & _pl_has_text(debtor)).then(debtor)
+            .when(incoming & _pl_has_text(creditor)).then(creditor)
+            .when(outgoing & _pl_has_text(creditor)).then(creditor)
+            .when(outgoing & _pl_has_text(debtor)).then(debtor)
+            .otherwise(fallback)
+        )
+    if "potential_duplicates" in wanted:
+        # ключове по суровите стойности, сравнени като в pandas пътя, а не като текст
+        prepared = prepared.with_columns(
+            raw_amount=_pl_key(columns, "transactionAmount.amount"),
+            raw_currency=_pl_key(columns, "transactionAmount.currency"),
+        )
+
+    # 🗂️ Подготвеният frame се изчислява веднъж, а заявките на секциите върху него - заедно
+    df = prepared.collect()
+    prepared = df.lazy()
+    queries = {}
+    if "summary" in wanted:
+        queries["totals"] = prepared.select(
+            total_income=pl.col("amount").filter(pl.col("amount") > 0).sum(),
+            total_expense=pl.col("amount").filter(pl.col("amount") <= 0).sum(),
+            net_result=pl.col("amount").sum(),
+            currency=pl.col("currency").first(),
+        )
+    if "daily_totals" in wanted:
+        queries["daily"] = (
+            prepared.filter(pl.col("bookingDate").is_not_null())
+            .group_by(day=pl.col("bookingDate").dt.strftime("%Y-%m-%d"))
+            .agg(pl.col("amount").sum())
+            .sort("day")
+        )
+    if "top_debtors" in wanted:
+        queries["top"] = (
+            prepared.filter(pl.col("counterparty").is_not_null())
+            .group_by("counterparty")
+            .agg(pl.col("amount").sum())
+            .sort("counterparty")
+            .sort("amount", descending=True, maintain_order=True)
+            .head(5)
+        )
+    if wanted & STATISTICS_SECTIONS:
+        ordered = (
+            prepared.filter(pl.col("counterparty").is_not_null())
+            .sort(["counterparty", "bookingDate"], nulls_last=True, maintain_order=True)
+            .with_columns(
+                position=pl.int_range(pl.len()).over("counterparty"),
+                interval=pl.col("bookingDate").diff().over("counterparty").dt.total_days(),
+                weekday=pl.col("bookingDate").dt.strftime("%A"),
+            )
+        )
+        queries["stats"] = ordered.group_by("counterparty").agg(
+            count=pl.len(),
+            mean=pl.col("amount").mean(),
+            std=pl.col("amount").std(ddof=1),
+            std_pop=pl.col("amount").std(ddof=0),
+            date_count=pl.col("bookingDate").count(),
+            interval_mean=pl.col("interval").mean(),
+            interval_std=pl.col("interval").std(ddof=1),
+            amount_sum=pl.col("amount").sum(),
+            weighted_sum=(pl.col("position") * pl.col("amount")).sum(),
+        ).sort("counterparty")
+        queries["weekdays"] = (
+            ordered.filter(pl.col("weekday").is_not_null())
+            .group_by("counterparty", "weekday").agg(n=pl.len())
+            .sort(["counterparty", "n", "weekday"], descending=[False, True, False])
+            .group_by("counterparty", maintain_order=True).first()
+        )
+    results = dict(zip(queries, pl.collect_all(queries.values())))
+
+    output = {}
+
+    # --- 🧮 Финансови суми ---
+    if "summary" in wanted:
+        totals = results["totals"].row(0, named=True)
+        output["summary"] = {
+            "total_income": round(np.float64(totals["total_income"]), 2),
+            "total_expense": round(np.float64(totals["total_expense"]), 2),
+            "net_result": round(np.float64(totals["net_result"]), 2),
+            "currency": totals["currency"],
+            **currency_summary(
+                df["amount"].to_numpy(), df["currency"].to_list(), df["bookingDate"].to_numpy(), reporting_currency
+            ),
+        }
+
+    # --- 📅 Дневни обобщения ---
+    if "daily_totals" in wanted:
+        daily = results["daily"]
+        output["daily_totals"] = dict(zip(daily["day"].to_list(), daily["amount"].to_list()))
+
+    # --- 💰 Топ контрагенти ---
+    if "top_debtors" in wanted:
+        top = results["top"]
+        output["top_debtors"] = dict(zip(top["counterparty"].to_list(), top["amount"].to_list()))
+
+    # --- 📐 Статистики по контрагент ---
+    if wanted & STATISTICS_SECTIONS:
+        stats = _pl_records(results["stats"]).set_index("counterparty").astype(float)
+        weekdays = _pl_records(results["weekdays"])
+        stats["slope"] = _trend_slope(stats["count"], stats["amount_sum"], stats["weighted_sum"])
+        stats["most_active_day"] = (
+            weekdays.set_index("counterparty")["weekday"].reindex(stats.index) if len(weekdays) else None
+        )
+
+    # --- 🔁 Честота на плащания ---
+    if "payment_frequency" in wanted:
+        output["payment_frequency"] = payment_frequency(stats)
+
+    # --- 🔍 Дублиращи се плащания ---
+    if "potential_duplicates" in wanted:
+        output["potential_duplicates"] = _polars_duplicates(df, columns, duplicate_window_days, amount_tolerance)
+
+    # --- ⚠️ Outlier detection ---
+    if "outliers" in wanted:
+        group_stats = pl.LazyFrame({
+            "counterparty": stats.index.tolist(),
+            "group_count": stats["count"].to_numpy(),
+            "mean": stats["mean"].to_numpy(),
+            "std_dev": stats["std_pop"].to_numpy(),
+        }, schema_overrides={"counterparty": pl.String})
+        flagged = (
+            df.lazy().join(group_stats, on="counterparty", how="inner")
+            .with_columns(z_score=(pl.col("amount") - pl.col("mean")) / pl.col("std_dev"))
+            .filter((pl.col("group_count") > 2) & (pl.col("std_dev") > 0) & (pl.col("z_score").abs() > 2.5))
+            .sort("row")
+            .select("counterparty", "amount", "mean", "std_dev", "z_score", "currency", "bookingDate")
+            .collect()
+        )
+        records = _pl_records(flagged)
+        records["bookingDate"] = pd.to_datetime(records["bookingDate"])
+        output["outliers"] = _outlier_records(records)
+
+    # --- 🧭 Поведенчески профили ---
+    if "behavioral_profiles" in wanted:
+        output["behavioral_profiles"] = behavioral_profiles(stats)
+
+    if "transaction_count" in wanted:
+        output["transaction_count"] = source.height
+
+    return output
+
+
+def _polars_duplicates(df, columns, window_days=None, amount_tolerance=0.0):
+    """potential_duplicates of a frame prepared by analyze_polars() (see find_duplicates / find_near_duplicates).
+
+    The raw field values of the matched rows are taken from the `columns`
+    lists, so they are reported exactly as they were sent.
+    """
+    if window_days is None:
+        keyed = df.filter(
+            pl.col("counterparty").is_not_null() & pl.col("raw_amount").is_not_null() & pl.col("raw_currency").is_not_null()
+        )
+        rows = keyed.filter(pl.struct("counterparty", "raw_amount", "raw_currency").is_duplicated())["row"]
+    else:
+        exact = amount_tolerance <= 0
+        key = ["counterparty", "raw_currency", "amount"] if exact else ["counterparty", "raw_currency"]
+        ordered = (
+            df.filter(pl.all_horizontal(pl.col(name).is_not_null() for name in key + ["bookingDate"]))
+            .sort(key + ["bookingDate"], maintain_order=True)
+        )
+        if ordered.height == 0:
+            return []
+        group = ordered.select(pl.struct(key).rle_id())[:, 0].to_numpy()
+        flagged = _window_matches(
+            group,
+            ordered["bookingDate"].dt.date().cast(pl.Int64).to_numpy(),
+            ordered["amount"].to_numpy(),
+            window_days,
+            amount_tolerance,
+        )
+        rows = ordered["row"].filter(pl.Series(flagged)).sort()
+
+    selected = df.filter(pl.col("row").is_in(rows.implode())).sort("row")
+    records = _pl_records(selected.select("bookingDate", "counterparty"))
+    for name in ("transactionAmount.amount", "transactionAmount.currency", "creditorAccount.iban", "remittanceInformationUnstructured"):
+        values = columns.get(name)
+        records[name] = [None if values is None else values[row] for row in selected["row"].to_list()]
+    records["bookingDate"] = pd.to_datetime(records["bookingDate"])
+    return _duplicate_records(records, pd.Series(True, index=records.index))
+
+
+# Настройки на вградения DuckDB: лимит на работната памет и директория за прехвърляне на диска
+DUCKDB_CONFIG = {
+    key: os.environ[name]
+    for key, name in (("memory_limit", "DUCKDB_MEMORY_LIMIT"), ("temp_directory", "DUCKDB_TEMP_DIRECTORY"))
+    if os.environ.get(name)
+}
+
+
+def _sql_has_text(column):
+    return f"({column} IS NOT NULL AND regexp_matches(CAST({column} AS VARCHAR), '\\S'))"
+
 
-            volatility = abs(std_amount / mean_amount) if mean_amount != 0 else 0
-            irregularity = (diffs.std() / avg_interval) if avg_interval and avg_interval > 0 else 0
-            risk_score = round(min(100, (volatility + irregularity) * 50), 2)
-
-            behavioral_profiles[debtor] = {
-                "avg_amount": round(mean_amount, 2),
-                "consistency": consistency,
-                "avg_interval_days": avg_interval,
-                "trend": trend_label,
-                "most_active_day": most_active_day,
-                "risk_score": risk_score
+def analyze_duckdb(
+    columns,
+    sections=None,
+    duplicate_window_days=None,
+    amount_tolerance=0.0,
+    remittance_prefixes=REMITTANCE_PREFIXES,
+    reporting_currency=None,
+):
+    """analyze_frame() expressed as SQL over an embedded DuckDB database.
+
+    The transactions are loaded into one table, and the summary, daily
+    totals, top counterparties, per-counterparty statistics, outlier and
+    duplicate masks are all computed by DuckDB's parallel vectorized engine.
+    The statement itself is handed over as an in-memory frame, so it has to
+    fit in RAM; DUCKDB_MEMORY_LIMIT and DUCKDB_TEMP_DIRECTORY only bound
+    DuckDB's own working memory for sorts and aggregations. Booking dates
+    are parsed with pd.to_datetime and the raw amount and currency keys of
+    the duplicate check are factorized before loading, so both mean the same
+    as on the pandas path. Output is assembled with the same helpers as the
+    pandas path.
+    """
+    raw = _columns_frame(columns)
+    if raw.empty:
+        return {"error": "No transactions found"}
+
+    wanted = set(SECTIONS if sections is None else sections)
+    has_currency = "transactionAmount.currency" in raw.columns
+    raw = raw.reindex(columns=list(TRANSACTION_FIELDS)).astype(object)
+    raw.insert(0, "row", np.arange(len(raw)))
+
+    with duckdb.connect(config=DUCKDB_CONFIG) as con:
+        # датите и ключовете на дубликатите се изчисляват като в pandas пътя
+        con.register("raw", raw.assign(
+            amount_key=pd.factorize(raw["transactionAmount.amount"])[0],
+            currency_key=pd.factorize(raw["transactionAmount.currency"])[0],
+            booked_at=pd.to_datetime(raw["bookingDate"], errors="coerce"),
+        ))
+        # без префикси в описанието не се търси контрагент
+        fallback = (
+            "NULLIF(regexp_replace(regexp_extract(remittance, $pattern, 1), '\\s+$', ''), '')"
+            if remittance_prefixes
+            else "NULL"
+        )
+        con.execute(f"""
+            CREATE TEMP TABLE transactions AS
+            SELECT *,
+                CASE
+                    WHEN amount > 0 AND {_sql_has_text("debtor")} THEN debtor
+                    WHEN amount > 0 AND {_sql_has_text("creditor")} THEN creditor
+                    WHEN amount < 0 AND {_sql_has_text("creditor")} THEN creditor
+                    WHEN amount < 0 AND {_sql_has_text("debtor")} THEN debtor
+                    ELSE {fallback}
+                END AS counterparty
+            FROM (
+                SELECT
+                    row,
+                    NULLIF(amount_key, -1) AS raw_amount,
+                    NULLIF(currency_key, -1) AS raw_currency,
+                    coalesce(nullif(TRY_CAST(CAST("transactionAmount.amount" AS VARCHAR) AS DOUBLE), 'NaN'), 0) AS amount,
+                    {'CAST("transactionAmount.currency" AS VARCHAR)' if has_currency else "'BGN'"} AS currency,
+                    CAST(booked_at AS TIMESTAMP) AS bookingDate,
+                    CAST("creditorName" AS VARCHAR) AS creditor,
+                    CAST("debtorName" AS VARCHAR) AS debtor,
+                    CAST("creditorAccount.iban" AS VARCHAR) AS iban,
+                    CAST("remittanceInformationUnstructured" AS VARCHAR) AS remittance
+                FROM raw
+            )
+        """, {"pattern": remittance_pattern(tuple(remittance_prefixes)).pattern} if remittance_prefixes else None)
+
+        output = {}
+
+        # --- 🧮 Финансови суми ---
+        if "summary" in wanted:
+            income, expense, net, currency = con.execute("""
+                SELECT coalesce(sum(amount) FILTER (WHERE amount > 0), 0),
+                       coalesce(sum(amount) FILTER (WHERE amount <= 0), 0),
+                       sum(amount),
+                       first(currency ORDER BY row)
+                FROM transactions
+            """).fetchone()
+            output["summary"] = {
+                "total_income": round(np.float64(income), 2),
+                "total_expense": round(np.float64(expense), 2),
+                "net_result": round(np.float64(net), 2),
+                "currency": currency,
+                **currency_summary(
+                    *con.execute("SELECT amount, currency, bookingDate FROM transactions ORDER BY row").fetchnumpy().values(),
+                    reporting_currency,
+                ),
             }
 
-    # --- 📊 Финален резултат ---
-    output = {
-        "summary": {
-            "total_income": round(total_income, 2),
-            "total_expense": round(total_expense, 2),
-            "net_result": round(net_result, 2),
-            "currency": df["currency"].iloc[0] if not df.empty else "BGN"
-        },
-        "daily_totals": daily_summary,
-        "top_debtors": top_counterparties,
-        "payment_frequency": payment_frequency,
-        "potential_duplicates": potential_duplicates,
-        "outliers": outliers,
-        "behavioral_profiles": behavioral_profiles,
-        "transaction_count": len(df)
+        # --- 📅 Дневни обобщения ---
+        if "daily_totals" in wanted:
+            output["daily_totals"] = dict(con.execute("""
+                SELECT strftime(bookingDate, '%Y-%m-%d') AS day, sum(amount)
+                FROM transactions WHERE bookingDate IS NOT NULL
+                GROUP BY day ORDER BY day
+            """).fetchall())
+
+        # --- 💰 Топ контрагенти ---
+        if "top_debtors" in wanted:
+            output["top_debtors"] = dict(con.execute("""
+                SELECT counterparty, sum(amount) AS total
+                FROM transactions WHERE counterparty IS NOT NULL
+                GROUP BY counterparty ORDER BY total DESC, counterparty LIMIT 5
+            """).fetchall())
+
+        # --- 📐 Статистики по контрагент ---
+        if wanted & STATISTICS_SECTIONS:
+            con.execute("""
+                CREATE TEMP TABLE ordered AS
+                SELECT counterparty, amount, bookingDate,
+                       row_number() OVER w - 1 AS position,
+                       floor((epoch(bookingDate) - epoch(lag(bookingDate) OVER w)) / 86400) AS interval,
+                       dayname(bookingDate) AS weekday
+                FROM transactions WHERE counterparty IS NOT NULL
+                WINDOW w AS (PARTITION BY counterparty ORDER BY bookingDate NULLS LAST, row)
+            """)
+            con.execute("""
+                CREATE TEMP TABLE stats AS
+                SELECT s.*, m.weekday AS most_active_day
+                FROM (
+                    SELECT counterparty,
+                           count(*) AS count,
+                           avg(amount) AS mean,
+                           stddev_samp(amount) AS std,
+                           stddev_pop(amount) AS std_pop,
+                           count(bookingDate) AS date_count,
+                           avg(interval) AS interval_mean,
+                           stddev_samp(interval) AS interval_std,
+                           sum(amount) AS amount_sum,
+                           sum(position * amount) AS weighted_sum
+                    FROM ordered GROUP BY counterparty
+                ) s
+                LEFT JOIN (
+                    SELECT counterparty, weekday
+                    FROM (SELECT counterparty, weekday, count(*) AS n FROM ordered WHERE weekday IS NOT NULL GROUP BY ALL)
+                    QUALIFY row_number() OVER (PARTITION BY counterparty ORDER BY n DESC, weekday) = 1
+                ) m USING (counterparty)
+            """)
+            stats = con.execute("SELECT * FROM stats ORDER BY counterparty").df().set_index("counterparty")
+            numeric = stats.columns.drop("most_active_day")
+            stats[numeric] = stats[numeric].astype(float)
+            stats["slope"] = _trend_slope(stats["count"], stats["amount_sum"], stats["weighted_sum"])
+
+        # --- 🔁 Честота на плащания ---
+        if "payment_frequency" in wanted:
+            output["payment_frequency"] = payment_frequency(stats)
+
+        # --- 🔍 Дублиращи се плащания ---
+        if "potential_duplicates" in wanted:
+            output["potential_duplicates"] = _duckdb_duplicates(con, raw, duplicate_window_days, amount_tolerance)
+
+        # --- ⚠️ Outlier detection ---
+        if "outliers" in wanted:
+            output["outliers"] = _outlier_records(con.execute("""
+                SELECT counterparty, amount, mean, std_dev, z_score, currency, bookingDate
+                FROM (
+                    SELECT t.row, t.counterparty, t.amount, s.mean, s.std_pop AS std_dev, s.count,
+                           (t.amount - s.mean) / nullif(s.std_pop, 0) AS z_score, t.currency, t.bookingDate
+                    FROM transactions t JOIN stats s USING (counterparty)
+                )
+                WHERE count > 2 AND std_dev > 0 AND abs(z_score) > 2.5
+                ORDER BY row
+            """).df())
+
+        # --- 🧭 Поведенчески профили ---
+        if "behavioral_profiles" in wanted:
+            output["behavioral_profiles"] = behavioral_profiles(stats)
+
+        if "transaction_count" in wanted:
+            output["transaction_count"] = len(raw)
+
+    return output
+
+
+def _duckdb_duplicates(con, raw, window_days=None, amount_tolerance=0.0):
+    """potential_duplicates of the `transactions` table (see find_duplicates / find_near_duplicates).
+
+    The raw field values of the matched rows are taken from `raw`, so they
+    are reported exactly as they were sent.
+    """
+    if window_days is None:
+        rows = con.execute("""
+            SELECT row FROM transactions
+            WHERE counterparty IS NOT NULL AND raw_amount IS NOT NULL AND raw_currency IS NOT NULL
+            QUALIFY count(*) OVER (PARTITION BY counterparty, raw_amount, raw_currency) > 1
+        """).df()["row"].to_numpy()
+    else:
+        key = "counterparty, raw_currency, amount" if amount_tolerance <= 0 else "counterparty, raw_currency"
+        ordered = con.execute(f"""
+            SELECT row, dense_rank() OVER (ORDER BY {key}) AS "group",
+                   CAST(bookingDate AS DATE) - DATE '1970-01-01' AS day, amount
+            FROM transactions
+            WHERE counterparty IS NOT NULL AND raw_currency IS NOT NULL AND bookingDate IS NOT NULL
+            ORDER BY {key}, bookingDate, row
+        """).df()
+        if ordered.empty:
+            return []
+        flagged = _window_matches(
+            ordered["group"].to_numpy(np.int64),
+            ordered["day"].to_numpy(np.int64),
+            ordered["amount"].to_numpy(),
+            window_days,
+            amount_tolerance,
+        )
+        rows = ordered.loc[flagged, "row"].to_numpy()
+
+    con.register("duplicate_rows", pd.DataFrame({"row": rows}))
+    resolved = con.execute("""
+        SELECT row, bookingDate, counterparty FROM transactions JOIN duplicate_rows USING (row) ORDER BY row
+    """).df()
+    records = raw.set_index("row").loc[resolved["row"]].reset_index(drop=True)
+    records[["bookingDate", "counterparty"]] = resolved[["bookingDate", "counterparty"]]
+    return _duplicate_records(records, pd.Series(True, index=records.index))
+
+
+# Стойността на секция за група, която няма нито един ред в нея
+_EMPTY_SECTIONS = {
+    "daily_totals": dict,
+    "top_debtors": dict,
+    "payment_frequency": dict,
+    "potential_duplicates": list,
+    "outliers": list,
+    "behavioral_profiles": dict,
+}
+
+
+def accounts_frame(payloads):
+    """Transactions of all `payloads` in one frame, with each row's account position in "account".
+
+    An account whose transactions carry none of TRANSACTION_FIELDS adds no
+    rows, so it is empty just as on its own in analyze_frame().
+    """
+    columns = {name: [] for name in TRANSACTION_FIELDS}
+    account = []
+    for position, payload in enumerate(payloads):
+        account_columns = payload_columns(payload)
+        if not any(value is not None for values in account_columns.values() for value in values):
+            continue
+        for name in TRANSACTION_FIELDS:
+            columns[name].extend(account_columns[name])
+        account.extend([position] * len(account_columns["bookingDate"]))
+
+    df = _columns_frame(columns)
+    df["account"] = np.array(account, dtype=np.int64)
+    return df
+
+
+def analyze_groups(
+    df,
+    groups,
+    counterparties=None,
+    sections=None,
+    duplicate_window_days=None,
+    amount_tolerance=0.0,
+    reporting_currency=None,
+):
+    """analyze_frame() results for every group of a prepared frame, keyed by group number.
+
+    `groups` holds a non-negative integer per row. `counterparties` is the
+    (codes, names) pair of pd.factorize(df["counterparty"], sort=True) and is
+    needed for the counterparty sections. Counterparty groups are keyed on
+    one integer made of (group, counterparty code), so the shared helpers run
+    once over the whole frame and their results split back per group in the
+    order a standalone run produces.
+    """
+    wanted = set(SECTIONS if sections is None else sections)
+    groups = pd.Series(np.asarray(groups, dtype=np.int64), index=df.index)
+    results = {
+        group: {section: empty() for section, empty in _EMPTY_SECTIONS.items() if section in wanted}
+        for group in groups.unique()
+    }
+
+    def per_group(values):
+        """(group, part) for a Series or frame indexed by (group, ...)."""
+        for group, part in values.groupby(level=0, sort=False):
+            yield group, part.droplevel(0)
+
+    if wanted & COUNTERPARTY_SECTIONS:
+        codes, names = counterparties
+        width = max(len(names), 1)
+        keyed = df.assign(counterparty=np.where(codes >= 0, groups * width + codes, np.nan))
+
+        def decode(keys):
+            """(group, counterparty) index of combined keys."""
+            keys = np.asarray(keys, dtype=np.int64)
+            return pd.MultiIndex.from_arrays([keys // width, names[keys % width]])
+
+    # --- 📐 Статистики по контрагент ---
+    if wanted & STATISTICS_SECTIONS:
+        keyed_stats = counterparty_statistics(keyed)
+        stats = keyed_stats.set_axis(decode(keyed_stats.index))
+
+    # --- 🧮 Финансови суми ---
+    if "summary" in wanted:
+        income = df["amount"] > 0
+        summary = pd.DataFrame({
+            "total_income": df["amount"].where(income, 0),
+            "total_expense": df["amount"].where(~income, 0),
+            "net_result": df["amount"],
+        }).groupby(groups).sum().round(2)
+        first = ~groups.duplicated()
+        summary["currency"] = pd.Series(df.loc[first, "currency"].to_numpy(), index=groups[first])
+        currencies = currency_summaries(df["amount"], df["currency"], df["bookingDate"], groups, reporting_currency)
+        for group, values in summary.to_dict("index").items():
+            results[group]["summary"] = {**values, **currencies[group]}
+
+    # --- 📅 Дневни обобщения ---
+    if "daily_totals" in wanted:
+        daily = df.groupby([groups, df["bookingDate"].dt.strftime("%Y-%m-%d")])["amount"].sum()
+        for group, part in per_group(daily):
+            results[group]["daily_totals"] = part.to_dict()
+
+    # --- 💰 Топ контрагенти ---
+    if "top_debtors" in wanted:
+        totals = keyed.groupby("counterparty")["amount"].sum()
+        for group, part in per_group(totals.set_axis(decode(totals.index))):
+            results[group]["top_debtors"] = part.sort_values(ascending=False).head(5).to_dict()
+
+    # --- 🔁 Честота на плащания ---
+    if "payment_frequency" in wanted:
+        for group, part in per_group(stats):
+            results[group]["payment_frequency"] = payment_frequency(part)
+
+    # --- 🔍 Дублиращи се плащания ---
+    if "potential_duplicates" in wanted:
+        if duplicate_window_days is None:
+            mask = duplicate_mask(keyed)
+        else:
+            mask = near_duplicate_mask(keyed, duplicate_window_days, amount_tolerance)
+        for group, record in zip(groups[mask], _duplicate_records(df, mask)):
+            results[group]["potential_duplicates"].append(record)
+
+    # --- ⚠️ Outlier detection ---
+    if "outliers" in wanted:
+        for record in detect_outliers(keyed, keyed_stats):
+            (group, record["counterparty"]), = decode([record["counterparty"]])
+            results[group]["outliers"].append(record)
+
+    # --- 🧭 Поведенчески профили ---
+    if "behavioral_profiles" in wanted:
+        for group, part in per_group(stats):
+            results[group]["behavioral_profiles"] = behavioral_profiles(part)
+
+    if "transaction_count" in wanted:
+        for group, count in groups.value_counts().items():
+            results[group]["transaction_count"] = count
+
+    return results
+
+
+def _prepare_accounts(payloads, sections, remittance_prefixes):
+    """accounts_frame() of `payloads`, prepared, with its counterparties dictionary-encoded when needed."""
+    df = accounts_frame(payloads)
+    if df.empty:
+        return df, None
+    prepare_transactions(df)
+
+    # сметка без валута в нито една транзакция получава "BGN", както когато се анализира сама
+    if "transactionAmount.currency" in df.columns:
+        carries_currency = df["transactionAmount.currency"].notna().groupby(df["account"]).transform("any")
+        df["currency"] = df["currency"].where(carries_currency, "BGN")
+
+    counterparties = None
+    if set(SECTIONS if sections is None else sections) & COUNTERPARTY_SECTIONS:
+        df["counterparty"] = resolve_counterparties(df, remittance_prefixes)
+        counterparties = pd.factorize(df["counterparty"], sort=True)
+    return df, counterparties
+
+
+def analyze_batch(
+    payloads,
+    sections=None,
+    duplicate_window_days=None,
+    amount_tolerance=0.0,
+    remittance_prefixes=REMITTANCE_PREFIXES,
+    reporting_currency=None,
+):
+    """analyze_frame() for many accounts at once, keyed by account id.
+
+    `payloads` maps account ids to /analyze payloads. Their transactions are
+    concatenated into one frame that is prepared and resolved once, and
+    every section is computed by a single grouped pass (see analyze_groups).
+    """
+    accounts = list(payloads)
+    results = {account_id: {"error": "No transactions found"} for account_id in accounts}
+
+    df, counterparties = _prepare_accounts(payloads.values(), sections, remittance_prefixes)
+    if df.empty:
+        return results
+
+    by_account = analyze_groups(
+        df, df["account"], counterparties, sections, duplicate_window_days, amount_tolerance, reporting_currency
+    )
+    for position, result in by_account.items():
+        results[accounts[position]] = result
+    return results
+
+
+def analyze_consolidated(
+    payloads,
+    sections=None,
+    duplicate_window_days=None,
+    amount_tolerance=0.0,
+    remittance_prefixes=REMITTANCE_PREFIXES,
+    reporting_currency=None,
+):
+    """One combined view over several accounts of the same customer.
+
+    The booked and pending lists of all `payloads` are merged into one frame
+    and their counterparties resolved and dictionary-encoded once. From that
+    shared frame the analysis runs per account and over all accounts
+    together; returns {"consolidated": ..., "accounts": {account_id: ...}}.
+    """
+    accounts = list(payloads)
+    results = {account_id: {"error": "No transactions found"} for account_id in accounts}
+
+    df, counterparties = _prepare_accounts(payloads.values(), sections, remittance_prefixes)
+    if df.empty:
+        return {"consolidated": {"error": "No transactions found"}, "accounts": results}
+
+    options = (sections, duplicate_window_days, amount_tolerance, reporting_currency)
+    for position, result in analyze_groups(df, df["account"], counterparties, *options).items():
+        results[accounts[position]] = result
+    consolidated = analyze_groups(df, np.zeros(len(df), dtype=np.int64), counterparties, *options)[0]
+    return {"consolidated": consolidated, "accounts": results}
+
+
+# Брой процеси за "sharded" изпълнителя; по подразбиране ядрата се делят между gunicorn работниците (WEB_CONCURRENCY)
+ANALYSIS_WORKERS = int(os.environ.get("ANALYSIS_WORKERS", 0)) or max(
+    1, (os.cpu_count() or 1) // max(1, int(os.environ.get("WEB_CONCURRENCY", 1)))
+)
+
+_shard_pool = None
+_shard_pool_lock = threading.Lock()
+
+
+def shard_pool():
+    """The process pool the "sharded" engine runs on, started on first use.
+
+    Workers are started with forkserver (spawn where it is unavailable):
+    the pool is created from a request thread, after polars, duckdb or
+    numba may have started threads that a fork would copy mid-state.
+    """
+    global _shard_pool
+    with _shard_pool_lock:
+        if _shard_pool is None:
+            method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            _shard_pool = ProcessPoolExecutor(ANALYSIS_WORKERS, mp_context=multiprocessing.get_context(method))
+        return _shard_pool
+
+
+def _run_shards(jobs):
+    """_analyze_shard() of every job on the shard pool.
+
+    A pool broken by a dead worker, e.g. one killed for running out of
+    memory, is dropped and the jobs run once more on a fresh pool.
+    """
+    global _shard_pool
+    pool = shard_pool()
+    try:
+        return list(pool.map(_analyze_shard, jobs))
+    except BrokenProcessPool:
+        with _shard_pool_lock:
+            if _shard_pool is pool:
+                _shard_pool = None
+        pool.shutdown(wait=False, cancel_futures=True)
+        return list(shard_pool().map(_analyze_shard, jobs))
+
+
+class _SharedColumns:
+    """NumPy columns copied into shared memory blocks for the pool workers.
+
+    `spec` describes the blocks by name, so a job only pickles that small
+    dict and the workers map the columns instead of receiving copies.
+    """
+
+    def __init__(self, columns):
+        self.blocks = []
+        self.spec = {}
+        for name, values in columns.items():
+            block = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+            np.ndarray(values.shape, dtype=values.dtype, buffer=block.buf)[:] = values
+            self.blocks.append(block)
+            self.spec[name] = (block.name, values.dtype.str, len(values))
+
+    def __enter__(self):
+        return self.spec
+
+    def __exit__(self, *exc):
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+
+
+def _read_shared_columns(spec, start, stop):
+    """Copy rows start:stop of every column in a _SharedColumns spec."""
+    columns = {}
+    for name, (block_name, dtype, length) in spec.items():
+        block = shared_memory.SharedMemory(name=block_name)
+        try:
+            columns[name] = np.ndarray(length, dtype=dtype, buffer=block.buf)[start:stop].copy()
+        finally:
+            block.close()
+    return columns
+
+
+def _dictionary_codes(series):
+    """Integer codes of a column's raw values as floats, NaN where the value is missing.
+
+    Equal values get equal codes, so duplicate matching on the codes gives
+    the same result as on the raw values.
+    """
+    codes = pd.factorize(series)[0].astype(np.float64)
+    codes[codes < 0] = np.nan
+    return codes
+
+
+def _analyze_shard(job):
+    """Counterparty sections of one shard, run in a pool worker.
+
+    Returns per-counterparty sums and statistics keyed by counterparty code
+    and the original row numbers of the potential duplicates.
+    """
+    spec, start, stop, wanted, duplicate_window_days, amount_tolerance = job
+    columns = _read_shared_columns(spec, start, stop)
+    df = pd.DataFrame({
+        "counterparty": columns["counterparty"],
+        "amount": columns["amount"],
+        "bookingDate": columns["bookingDate"].view("datetime64[ns]"),
+        "transactionAmount.amount": columns["raw_amount"],
+        "transactionAmount.currency": columns["currency"],
+    }, index=columns["row"])
+
+    part = {}
+    if "top_debtors" in wanted:
+        part["totals"] = df.groupby("counterparty")["amount"].sum()
+    if wanted & STATISTICS_SECTIONS:
+        part["stats"] = counterparty_statistics(df)
+    if "potential_duplicates" in wanted:
+        if duplicate_window_days is None:
+            mask = duplicate_mask(df)
+        else:
+            mask = near_duplicate_mask(df, duplicate_window_days, amount_tolerance)
+        part["duplicates"] = df.index[mask.to_numpy()].to_numpy()
+    return part
+
+
+def analyze_sharded(
+    df,
+    sections=None,
+    duplicate_window_days=None,
+    amount_tolerance=0.0,
+    remittance_prefixes=REMITTANCE_PREFIXES,
+    reporting_currency=None,
+):
+    """analyze_frame() with the counterparty sections spread over a process pool.
+
+    Counterparties are resolved here and the rows are split into
+    ANALYSIS_WORKERS shards by a hash of the counterparty, so every
+    counterparty lives in exactly one shard. The numeric columns, with
+    counterparty, raw amount and currency dictionary-encoded, go to the
+    workers through shared memory; their totals, statistics and duplicate
+    rows are merged back and the sections assembled as in analyze_frame().
+    """
+    if df.empty:
+        return {"error": "No transactions found"}
+
+    wanted = set(SECTIONS if sections is None else sections)
+
+    # 🧮 Секциите без контрагент се смятат тук, върху целия frame
+    output = analyze_frame(df, sections=wanted - COUNTERPARTY_SECTIONS, reporting_currency=reporting_currency)
+    if not wanted & COUNTERPARTY_SECTIONS:
+        return output
+
+    # 🧭 Определяне на контрагента
+    df["counterparty"] = resolve_counterparties(df, remittance_prefixes)
+    codes, names = pd.factorize(df["counterparty"], sort=True)
+
+    # 🔀 Разделяне по хеш на контрагента
+    rows = np.flatnonzero(codes >= 0)
+    shard = (pd.util.hash_array(names.to_numpy()) % ANALYSIS_WORKERS)[codes[rows]]
+    order = np.argsort(shard, kind="stable")
+    rows = rows[order]
+    bounds = np.searchsorted(shard[order], np.arange(ANALYSIS_WORKERS + 1))
+
+    columns = {
+        "row": rows.astype(np.int64),
+        "counterparty": codes[rows].astype(np.int64),
+        "amount": df["amount"].to_numpy(dtype=np.float64)[rows],
+        "bookingDate": df["bookingDate"].to_numpy(dtype="datetime64[ns]").view(np.int64)[rows],
+        "raw_amount": _dictionary_codes(_text_column(df, "transactionAmount.amount"))[rows],
+        "currency": _dictionary_codes(_text_column(df, "transactionAmount.currency"))[rows],
     }
+    with _SharedColumns(columns) as spec:
+        jobs = [
+            (spec, start, stop, wanted, duplicate_window_days, amount_tolerance)
+            for start, stop in zip(bounds[:-1], bounds[1:])
+            if stop > start
+        ]
+        parts = _run_shards(jobs) or [_analyze_shard((spec, 0, 0, wanted, None, 0.0))]
+
+    # --- 🧩 Сливане на резултатите от дяловете ---
+    def merged(key):
+        combined = pd.concat([part[key] for part in parts]).sort_index()
+        combined.index = pd.Index(names[combined.index], name="counterparty")
+        return combined
+
+    stats = merged("stats") if wanted & STATISTICS_SECTIONS else None
+
+    if "top_debtors" in wanted:
+        output["top_debtors"] = merged("totals").sort_values(ascending=False).head(5).to_dict()
+
+    if "payment_frequency" in wanted:
+        output["payment_frequency"] = payment_frequency(stats)
+
+    if "potential_duplicates" in wanted:
+        mask = np.zeros(len(df), dtype=bool)
+        mask[np.concatenate([part["duplicates"] for part in parts])] = True
+        output["potential_duplicates"] = _duplicate_records(df, pd.Series(mask, index=df.index))
+
+    if "outliers" in wanted:
+        output["outliers"] = detect_outliers(df, stats)
+
+    if "behavioral_profiles" in wanted:
+        output["behavioral_profiles"] = behavioral_profiles(stats)
 
     return output
 
 
+def _canonical_json(obj):
+    """Key-order independent JSON bytes of `obj`, used for content hashing."""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, sort_keys=True, separators=(",", ":"), default=str).encode()
+
+
+def payload_digest(data, options):
+    """Content hash of a JSON payload together with the analysis options."""
+    digest = hashlib.sha256(_canonical_json(options))
+    digest.update(_canonical_json(data))
+    return digest.hexdigest()
+
+
+def upload_digest(stream, options):
+    """Content hash of an uploaded file together with the analysis options; rewinds the stream."""
+    digest = hashlib.sha256(_canonical_json(options))
+    for chunk in iter(lambda: stream.read(1 << 16), b""):
+        digest.update(chunk)
+    stream.seek(0)
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """Thread-safe LRU cache of encoded /analyze responses with a per-entry TTL.
+
+    Entries older than `ttl` seconds are treated as misses and dropped; once
+    `maxsize` entries are stored the least recently used one is evicted.
+    A `maxsize` of 0 disables caching.
+    """
+
+    def __init__(self, maxsize=128, ttl=300.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry[0] <= self.ttl:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "backend": "local",
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+class RedisResultCache:
+    """ResultCache counterpart stored in Redis, shared by all gunicorn workers.
+
+    `client` is anything speaking the redis-py API (a redis.Redis instance,
+    or e.g. fakeredis in tests). Entries expire after `ttl` seconds; size
+    bounds and LRU eviction are left to the server's maxmemory policy.
+    Hit/miss counters live in Redis too, so they cover every worker. Redis
+    errors are logged and treated as misses, never failing a request.
+    """
+
+    errors = (redis.RedisError, OSError) if redis is not None else (OSError,)
+
+    def __init__(self, client, ttl=300.0, prefix="analyze:"):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        try:
+            value = self.client.get(self.prefix + key)
+            self.client.incr(self.prefix + ("stats:hits" if value is not None else "stats:misses"))
+            return value
+        except self.errors:
+            app.logger.warning("Result cache read failed", exc_info=True)
+            return None
+
+    def set(self, key, value):
+        try:
+            self.client.set(self.prefix + key, value, ex=max(1, math.ceil(self.ttl)))
+        except self.errors:
+            app.logger.warning("Result cache write failed", exc_info=True)
+
+    def clear(self):
+        try:
+            for name in self.client.scan_iter(match=self.prefix + "*"):
+                self.client.delete(name)
+        except self.errors:
+            app.logger.warning("Result cache clear failed", exc_info=True)
+
+    def stats(self):
+        try:
+            hits, misses = self.client.mget(self.prefix + "stats:hits", self.prefix + "stats:misses")
+        except self.errors:
+            app.logger.warning("Result cache stats read failed", exc_info=True)
+            return {"backend": "redis", "ttl": self.ttl, "hits": None, "misses": None, "error": "Redis unavailable"}
+        return {"backend": "redis", "ttl": self.ttl, "hits": int(hits or 0), "misses": int(misses or 0)}
+
+
+def make_result_cache():
+    """Result cache configured from the environment.
+
+    ANALYSIS_CACHE_URL (e.g. redis://host:6379/0) selects the shared Redis
+    backend when redis is installed; otherwise each worker keeps a local
+    ResultCache. ANALYSIS_CACHE_SIZE and ANALYSIS_CACHE_TTL size both.
+    """
+    ttl = float(os.environ.get("ANALYSIS_CACHE_TTL", 300))
+    url = os.environ.get("ANALYSIS_CACHE_URL")
+    if url and redis is not None:
+        return RedisResultCache(redis.Redis.from_url(url), ttl=ttl)
+    return ResultCache(maxsize=int(os.environ.get("ANALYSIS_CACHE_SIZE", 128)), ttl=ttl)
+
+
+result_cache = make_result_cache()
+state_store = StateStore(
+    redis.Redis.from_url(os.environ["ANALYSIS_STATE_URL"])
+    if os.environ.get("ANALYSIS_STATE_URL") and redis is not None
+    else None
+)
+if state_store.client is None:
+    # без споделено хранилище всеки gunicorn работник има свои сметки, които се губят при рестарт
+    app.logger.warning(
+        "ANALYSIS_STATE_URL is not set (or redis is not installed): /accounts state is kept in this "
+        "process's memory, is not shared between workers and is lost on restart"
+    )
+
+
 @app.route("/analyze", methods=["POST"])
 def analyze():
+    options = {
+        "duplicate_window_days": request.args.get("duplicate_window_days", type=int),
+        "amount_tolerance": request.args.get("amount_tolerance", 0.0, type=float),
+        "remittance_prefixes": _requested_prefixes(),
+        "engine": request.args.get("engine"),
+        "reporting_currency": request.args.get("reporting_currency", type=str.upper),
+    }
+    if options["engine"] not in (None, *ENGINES):
+        return jsonify({"error": f"Unknown engine: {options['engine']}"}), 400
+
+    sections, error = _requested_sections(SECTIONS)
+    if error:
+        return error
+    if sections:
+        options["sections"] = sections
+
+    # 💱 преизчислените суми зависят и от таблицата с курсове
+    digest_options = {**options, "fx_rates": FX_RATES_VERSION} if options["reporting_currency"] else options
+
     if request.is_json:
         data = request.get_json()
+        key = payload_digest(data, digest_options)
+        run = lambda: analyze_transactions(data, **options)
+    elif "file" in request.files:
+        upload = request.files["file"].stream
+        key = upload_digest(upload, digest_options)
+        run = lambda: analyze_columns(read_transaction_columns(upload), **options)
+    else:
+        return jsonify({"error": "No JSON or file uploaded"}), 400
+
+    # 🏷️ Клиентът вече има резултата за това съдържание
+    if request.if_none_match.contains_weak(key):
+        response = app.response_class(status=304)
+        response.set_etag(key)
+        return response
+
+    # 🗄️ Повторно изпратено извлечение се връща от кеша
+    body = result_cache.get(key)
+    if body is None:
+        try:
+            body = jsonify(run()).get_data()
+        except json.JSONDecodeError as e:
+            return jsonify({"error": f"Invalid JSON upload: {e}"}), 400
+        result_cache.set(key, body)
+        status = "MISS"
+    else:
+        status = "HIT"
+
+    response = app.response_class(body, mimetype=app.json.mimetype)
+    response.headers["X-Cache"] = status
+    response.set_etag(key)
+    return response
+
+
+@app.route("/analyze/cache", methods=["GET"])
+def analyze_cache_stats():
+    return jsonify(result_cache.stats())
+
+
+def _is_payload(payload):
+    """Whether `payload` has the /analyze shape: {"transactions": {"booked": [...], "pending": [...]}}."""
+    if not isinstance(payload, dict):
+        return False
+    transactions = payload.get("transactions", {})
+    return isinstance(transactions, dict) and all(
+        isinstance(transactions.get(name, []), list) for name in ("booked", "pending")
+    )
+
+
+@app.route("/analyze/batch", methods=["POST"])
+def analyze_batch_route():
+    """Analyze {"accounts": {account_id: payload, ...}} and return the /analyze result of each account."""
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get("accounts"), dict):
+        return jsonify({"error": "Expected a JSON object with an 'accounts' mapping"}), 400
+    invalid = [account_id for account_id, payload in data["accounts"].items() if not _is_payload(payload)]
+    if invalid:
+        return jsonify({"error": f"Invalid payload for accounts: {', '.join(map(str, invalid))}"}), 400
+
+    sections, error = _requested_sections(SECTIONS)
+    if error:
+        return error
+
+    return jsonify({"accounts": analyze_batch(
+        data["accounts"],
+        sections=sections,
+        duplicate_window_days=request.args.get("duplicate_window_days", type=int),
+        amount_tolerance=request.args.get("amount_tolerance", 0.0, type=float),
+        remittance_prefixes=_requested_prefixes(),
+        reporting_currency=request.args.get("reporting_currency", type=str.upper),
+    )})
+
+
+@app.route("/analyze/consolidated", methods=["POST"])
+def analyze_consolidated_route():
+    """Combined analysis of {"accounts": {account_id: payload, ...}}, overall and per account."""
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get("accounts"), dict):
+        return jsonify({"error": "Expected a JSON object with an 'accounts' mapping"}), 400
+    invalid = [account_id for account_id, payload in data["accounts"].items() if not _is_payload(payload)]
+    if invalid:
+        return jsonify({"error": f"Invalid payload for accounts: {', '.join(map(str, invalid))}"}), 400
+
+    sections, error = _requested_sections(SECTIONS)
+    if error:
+        return error
+
+    return jsonify(analyze_consolidated(
+        data["accounts"],
+        sections=sections,
+        duplicate_window_days=request.args.get("duplicate_window_days", type=int),
+        amount_tolerance=request.args.get("amount_tolerance", 0.0, type=float),
+        remittance_prefixes=_requested_prefixes(),
+        reporting_currency=request.args.get("reporting_currency", type=str.upper),
+    ))
+
+
+def _requested_prefixes():
+    """Remittance prefixes from ?remittance_prefix=... (repeatable), REMITTANCE_PREFIXES when none are given."""
+    return tuple(p for p in request.args.getlist("remittance_prefix") if p) or REMITTANCE_PREFIXES
+
+
+def _requested_sections(allowed):
+    """Sections from ?sections=..., or an error response if any is not in `allowed`."""
+    # напр. ?sections=summary,daily_totals или ?sections=summary&sections=daily_totals
+    sections = {name for value in request.args.getlist("sections") for name in value.split(",") if name}
+    unknown = sections.difference(allowed)
+    if unknown:
+        return None, (jsonify({"error": f"Unknown sections: {', '.join(sorted(unknown))}"}), 400)
+    return (tuple(sorted(sections)) if sections else None), None
+
+
+@app.route("/accounts/<account_id>/transactions", methods=["POST"])
+def update_account(account_id):
+    """Append new transactions to an account's state; ?reset=1 starts it over."""
+    sections, error = _requested_sections(AccountState.SECTIONS)
+    if error:
+        return error
+
+    if request.is_json:
+        df = payload_frame(request.get_json())
     elif "file" in request.files:
-        data = json.load(request.files["file"])
+        try:
+            df = read_transactions_frame(request.files["file"].stream)
+        except json.JSONDecodeError as e:
+            return jsonify({"error": f"Invalid JSON upload: {e}"}), 400
     else:
         return jsonify({"error": "No JSON or file uploaded"}), 400
 
-    result = analyze_transactions(data)
-    return jsonify(result)
+    reset = request.args.get("reset", type=int)
+    prefixes = _requested_prefixes()
+
+    def change(blob):
+        state = AccountState(prefixes) if reset or blob is None else AccountState.from_json(blob)
+        state.update(df.copy())
+        return state.to_json(), state
+
+    try:
+        state = state_store.update(account_id, change)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 409
+
+    return jsonify(state.result(sections, request.args.get("reporting_currency", type=str.upper)))
+
+
+@app.route("/accounts/<account_id>/analysis", methods=["GET"])
+def account_analysis(account_id):
+    sections, error = _requested_sections(AccountState.SECTIONS)
+    if error:
+        return error
+
+    blob = state_store.get(account_id)
+    if blob is None:
+        return jsonify({"error": "Unknown account"}), 404
+    return jsonify(AccountState.from_json(blob).result(sections, request.args.get("reporting_currency", type=str.upper)))
+
+
+@app.route("/accounts/<account_id>", methods=["DELETE"])
+def delete_account(account_id):
+    if not state_store.delete(account_id):
+        return jsonify({"error": "Unknown account"}), 404
+    return "", 204
 
 
 if __name__ == "__main__":
@@ -0,0 +1,84 @@
+"""Incremental account state must match a full analysis of the account's history."""
+import threading
+
+import pytest
+
+import main
+from test_engines import analyze, assert_close, statement
+
+fakeredis = pytest.importorskip("fakeredis")
+
+
+@pytest.fixture(params=["local", "redis"])
+def client(request, monkeypatch):
+    store = main.StateStore(fakeredis.FakeRedis() if request.param == "redis" else None)
+    monkeypatch.setattr(main, "state_store", store)
+    return main.app.test_client()
+
+
+def history(rows, seed):
+    """A generated statement's transactions in booking order."""
+    transactions = statement(rows, seed)["transactions"]
+    return sorted(transactions["booked"] + transactions["pending"], key=lambda t: t["bookingDate"] or "")
+
+
+def post(client, account_id, transactions, query=""):
+    return client.post(f"/accounts/{account_id}/transactions{query}", json={"transactions": {"booked": transactions}})
+
+
+@pytest.mark.parametrize("rows,seed", [(40, 11), (400, 12), (1500, 13)])
+def test_appends_match_full_analysis(client, rows, seed):
+    transactions = history(rows, seed)
+    third = len(transactions) // 3
+    chunks = [transactions[:third], transactions[third:2 * third], transactions[2 * third:]]
+
+    assert post(client, "acc", chunks[0], "?reset=1").status_code == 200
+    assert post(client, "acc", chunks[1]).status_code == 200
+    response = post(client, "acc", chunks[2])
+    assert response.status_code == 200
+
+    expected = analyze({"transactions": {"booked": transactions}}, engine="pandas", sections=main.AccountState.SECTIONS)
+    assert_close(expected, response.get_json())
+    assert_close(expected, client.get("/accounts/acc/analysis").get_json())
+
+
+def test_older_transactions_are_rejected(client):
+    transactions = [t for t in history(200, 14) if t.get("creditorName") == "Company 1" and t["bookingDate"]]
+    assert post(client, "acc", transactions[len(transactions) // 2:], "?reset=1").status_code == 200
+    before = client.get("/accounts/acc/analysis").get_json()
+
+    response = post(client, "acc", transactions[:1])
+    assert response.status_code == 409
+    assert "older than the stored history" in response.get_json()["error"]
+    assert client.get("/accounts/acc/analysis").get_json() == before
+
+
+def test_concurrent_appends_are_all_kept(client):
+    transaction = {"transactionAmount": {"amount": "1", "currency": "BGN"}, "creditorName": "X"}
+
+    def append():
+        for _ in range(5):
+            assert post(client, "acc", [transaction] * 3).status_code == 200
+
+    threads = [threading.Thread(target=append) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert client.get("/accounts/acc/analysis").get_json()["transaction_count"] == 60
+
+
+def test_update_retries_on_concurrent_redis_writes():
+    server = fakeredis.FakeServer()
+    stores = [main.StateStore(fakeredis.FakeRedis(server=server)) for _ in range(4)]
+
+    def change(blob):
+        count = int(blob or 0) + 1
+        return str(count), count
+
+    threads = [threading.Thread(target=lambda store=store: [store.update("k", change) for _ in range(50)]) for store in stores * 2]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert int(stores[0].get("k")) == 400
@@ -0,0 +1,110 @@
+"""/analyze result caching and ETags on the local and Redis backends."""
+import io
+import json
+
+import pytest
+
+import main
+from test_engines import statement
+
+fakeredis = pytest.importorskip("fakeredis")
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(main.time, "monotonic", clock)
+    return clock
+
+
+def test_lru_eviction():
+    cache = main.ResultCache(maxsize=2)
+    cache.set("a", b"1")
+    cache.set("b", b"2")
+    assert cache.get("a") == b"1"
+    cache.set("c", b"3")
+
+    assert cache.get("b") is None
+    assert cache.get("a") == b"1" and cache.get("c") == b"3"
+    assert cache.stats() == {"backend": "local", "size": 2, "maxsize": 2, "ttl": 300.0, "hits": 3, "misses": 1}
+
+
+def test_ttl_expiry(clock):
+    cache = main.ResultCache(ttl=10)
+    cache.set("a", b"1")
+    clock.now += 10
+    assert cache.get("a") == b"1"
+    clock.now += 0.5
+    assert cache.get("a") is None
+    assert cache.stats()["size"] == 0
+
+
+def test_zero_maxsize_disables_caching():
+    cache = main.ResultCache(maxsize=0)
+    cache.set("a", b"1")
+    assert cache.get("a") is None
+
+
+def test_redis_cache():
+    client = fakeredis.FakeRedis()
+    cache = main.RedisResultCache(client, ttl=30)
+    assert cache.get("a") is None
+    cache.set("a", b"1")
+    assert cache.get("a") == b"1"
+    assert 0 < client.ttl("analyze:a") <= 30
+    assert cache.stats() == {"backend": "redis", "ttl": 30, "hits": 1, "misses": 1}
+
+    cache.clear()
+    assert cache.get("a") is None
+    assert cache.stats()["hits"] == 0
+
+
+def test_redis_cache_without_redis():
+    server = fakeredis.FakeServer()
+    cache = main.RedisResultCache(fakeredis.FakeRedis(server=server))
+    server.connected = False
+
+    cache.set("a", b"1")
+    assert cache.get("a") is None
+    cache.clear()
+    assert cache.stats() == {"backend": "redis", "ttl": 300.0, "hits": None, "misses": None, "error": "Redis unavailable"}
+
+
+@pytest.fixture(params=["local", "redis"])
+def client(request, monkeypatch):
+    cache = main.ResultCache() if request.param == "local" else main.RedisResultCache(fakeredis.FakeRedis())
+    monkeypatch.setattr(main, "result_cache", cache)
+    return main.app.test_client()
+
+
+def test_repost_is_a_cache_hit(client):
+    data = statement(50, 21)
+    first = client.post("/analyze", json=data)
+    second = client.post("/analyze", json=data)
+    assert (first.headers["X-Cache"], second.headers["X-Cache"]) == ("MISS", "HIT")
+    assert first.data == second.data and first.headers["ETag"] == second.headers["ETag"]
+
+    assert client.post("/analyze?sections=summary", json=data).headers["X-Cache"] == "MISS"
+
+    body = json.dumps(data).encode()
+    uploads = [client.post("/analyze", data={"file": (io.BytesIO(body), "statement.json")}) for _ in range(2)]
+    assert [response.headers["X-Cache"] for response in uploads] == ["MISS", "HIT"]
+
+
+def test_matching_etag_is_not_modified(client):
+    data = statement(50, 22)
+    etag = client.post("/analyze", json=data).headers["ETag"]
+
+    response = client.post("/analyze", json=data, headers={"If-None-Match": etag})
+    assert response.status_code == 304 and not response.data
+    assert response.headers["ETag"] == etag
+
+    assert client.post("/analyze?engine=pandas", json=data, headers={"If-None-Match": etag}).status_code == 200
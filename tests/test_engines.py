@@ -0,0 +1,201 @@
+"""Every engine in ENGINES must produce the same analysis as engine="pandas"."""
+import json
+import os
+import random
+import subprocess
+import sys
+
+import pandas as pd
+import pytest
+
+import main
+
+NAMES = [f"Company {i}" for i in range(12)]
+
+
+def statement(rows, seed):
+    """A generated statement with null and invalid dates, remittance-only rows and duplicates."""
+    rng = random.Random(seed)
+    booked = []
+    for _ in range(rows):
+        amount = round(rng.choice([1, -1]) * rng.uniform(1, 500), 2)
+        if rng.random() < 0.2:
+            amount = rng.choice([100.0, -100.0, 50.0, -25.5])
+        if rng.random() < 0.02:
+            amount = 0.0
+        transaction = {
+            "transactionAmount": {"amount": str(amount), "currency": rng.choice(["BGN", "BGN", "EUR", "USD"])},
+            "bookingDate": f"2024-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+        }
+        kind = rng.random()
+        if kind < 0.4:
+            transaction["creditorName"] = rng.choice(NAMES)
+        elif kind < 0.7:
+            transaction["debtorName"] = rng.choice(NAMES)
+        elif kind < 0.8:
+            transaction["creditorName"] = "  "
+            transaction["debtorName"] = rng.choice(NAMES)
+        elif kind < 0.9:
+            transaction["remittanceInformationUnstructured"] = f"Pay AZV-{rng.choice(NAMES)} , x"
+        else:
+            transaction["remittanceInformationUnstructured"] = "nothing"
+        if rng.random() < 0.02:
+            del transaction["transactionAmount"]["currency"]
+        if rng.random() < 0.03:
+            transaction["bookingDate"] = None
+        elif rng.random() < 0.01:
+            transaction["bookingDate"] = "not a date"
+        booked.append(transaction)
+
+        # повторени и близки плащания към същия контрагент
+        if rng.random() < 0.1:
+            booked.append(json.loads(json.dumps(transaction)))
+        if rng.random() < 0.1 and transaction["bookingDate"] and transaction["bookingDate"][0] == "2":
+            nearby = json.loads(json.dumps(transaction))
+            day = pd.Timestamp(transaction["bookingDate"]) + pd.Timedelta(days=rng.randint(1, 12))
+            nearby["bookingDate"] = day.strftime("%Y-%m-%d")
+            nearby["transactionAmount"]["amount"] = str(round(amount + rng.uniform(-6, 6), 2))
+            booked.append(nearby)
+
+    split = len(booked) * 3 // 4
+    return {"transactions": {"booked": booked[:split], "pending": booked[split:]}}
+
+
+def assert_close(expected, actual, path="$"):
+    """Compare decoded results, allowing 0.01 between numbers."""
+    if isinstance(expected, dict):
+        assert isinstance(actual, dict), path
+        assert sorted(expected) == sorted(actual), path
+        for key in expected:
+            assert_close(expected[key], actual[key], f"{path}.{key}")
+    elif isinstance(expected, list):
+        assert isinstance(actual, list) and len(expected) == len(actual), path
+        for index, (left, right) in enumerate(zip(expected, actual)):
+            assert_close(left, right, f"{path}[{index}]")
+    elif isinstance(expected, (int, float)) and not isinstance(expected, bool):
+        assert isinstance(actual, (int, float)) and not isinstance(actual, bool), path
+        assert round(abs(actual - expected), 2) <= 0.01, (path, expected, actual)
+    else:
+        assert expected == actual, path
+
+
+def analyze(data, **options):
+    """analyze_transactions() as the /analyze route returns it."""
+    return json.loads(main.app.json.dumps(main.analyze_transactions(data, **options)))
+
+
+@pytest.fixture
+def fx_rates(tmp_path, monkeypatch):
+    path = tmp_path / "fx.csv"
+    path.write_text(
+        "date,currency,rate\n"
+        "2024-01-01,BGN,0.51129\n"
+        "2024-03-01,USD,0.92\n"
+        "2024-07-01,USD,0.9\n"
+        "2024-10-15,USD,0.95\n"
+    )
+    monkeypatch.setattr(main, "FX_RATES", main.load_fx_rates(path))
+
+
+OPTIONS = [
+    {},
+    {"duplicate_window_days": 7},
+    {"duplicate_window_days": 10, "amount_tolerance": 5.0},
+    {"sections": ("summary", "top_debtors", "outliers")},
+    {"remittance_prefixes": ()},
+    {"remittance_prefixes": ("AZV-", "Pay ")},
+    {"reporting_currency": "EUR"},
+    {"reporting_currency": "USD"},
+]
+
+
+@pytest.mark.parametrize("options", OPTIONS, ids=lambda options: ",".join(options) or "default")
+@pytest.mark.parametrize("rows,seed", [(1, 1), (40, 2), (150, 3), (1500, 4)])
+@pytest.mark.parametrize("engine", ["numpy", "sharded", "polars", "duckdb"])
+def test_engine_matches_pandas(engine, rows, seed, options, fx_rates):
+    if engine in ("polars", "duckdb"):
+        pytest.importorskip(engine)
+    data = statement(rows, seed)
+    assert_close(analyze(data, engine="pandas", **options), analyze(data, engine=engine, **options))
+
+
+@pytest.mark.parametrize("rows", [5, main.SMALL_STATEMENT_ROWS - 1])
+def test_small_statements_default_to_numpy(rows, monkeypatch):
+    data = statement(rows, rows)
+    while len(main.payload_columns(data)["bookingDate"]) >= main.SMALL_STATEMENT_ROWS:
+        data["transactions"]["pending"].pop()
+    expected = analyze(data, engine="pandas")
+
+    monkeypatch.setattr(main, "analyze_frame", None)
+    assert_close(expected, analyze(data))
+
+
+def test_empty_statement():
+    empty = {"transactions": {"booked": [], "pending": []}}
+    for engine in main.ENGINES:
+        assert analyze(empty, engine=engine) == {"error": "No transactions found"}
+
+
+@pytest.mark.parametrize("rows,seed", [(1, 5), (40, 6), (1500, 7)])
+def test_numba_matches_fallback(rows, seed, monkeypatch):
+    pytest.importorskip("numba")
+    df = main.payload_frame(statement(rows, seed))
+    main.prepare_transactions(df)
+    df["counterparty"] = main.resolve_counterparties(df)
+    compiled = main.counterparty_statistics(df)
+    expected = analyze(statement(rows, seed), engine="pandas")
+
+    monkeypatch.setattr(main, "numba", None)
+    fallback = main.counterparty_statistics(df)
+    pd.testing.assert_frame_equal(compiled[fallback.columns], fallback, check_dtype=False)
+    assert_close(expected, analyze(statement(rows, seed), engine="pandas"))
+
+
+def test_sharded_engine_replaces_a_broken_pool():
+    data = statement(300, 8)
+    expected = analyze(data, engine="pandas")
+    assert_close(expected, analyze(data, engine="sharded"))
+
+    broken = main.shard_pool()
+    for process in list(broken._processes.values()):
+        process.kill()
+    assert_close(expected, analyze(data, engine="sharded"))
+    assert main.shard_pool() is not broken
+
+
+def test_unknown_analysis_engine_is_rejected():
+    env = {**os.environ, "ANALYSIS_ENGINE": "polar"}
+    result = subprocess.run(
+        [sys.executable, "-c", "import main"], cwd=os.path.dirname(main.__file__), env=env, capture_output=True, text=True
+    )
+    assert result.returncode != 0
+    assert "ANALYSIS_ENGINE='polar' is not one of the available engines" in result.stderr
+
+
+def typed_statement(amounts, dates):
+    booked = [
+        {"transactionAmount": {"amount": amount, "currency": "BGN"}, "bookingDate": date, "creditorName": name}
+        for name in ("A", "B")
+        for amount, date in zip(amounts, dates)
+    ]
+    return {"transactions": {"booked": booked}}
+
+
+@pytest.mark.parametrize("engine", ["numpy", "sharded", "polars", "duckdb"])
+def test_duplicates_compare_raw_amounts_by_value(engine):
+    if engine in ("polars", "duckdb"):
+        pytest.importorskip(engine)
+    data = typed_statement(["-100.0", -100.0, -100, "-50", -50.5], ["2024-01-0%d" % day for day in range(1, 6)])
+    expected = analyze(data, engine="pandas", sections=("potential_duplicates",))
+    assert len(expected["potential_duplicates"]) == 4
+    assert_close(expected, analyze(data, engine=engine, sections=("potential_duplicates",)))
+
+
+@pytest.mark.parametrize("engine", ["numpy", "sharded", "duckdb"])
+def test_non_iso_booking_dates(engine):
+    if engine == "duckdb":
+        pytest.importorskip(engine)
+    data = typed_statement(["-10", "-12", "-11"], ["01/02/2024", "01/09/2024", "01/20/2024"])
+    expected = analyze(data, engine="pandas")
+    assert expected["payment_frequency"] == {"A": 9.0, "B": 9.0}
+    assert_close(expected, analyze(data, engine=engine))
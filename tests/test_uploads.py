@@ -0,0 +1,56 @@
+"""File uploads must analyze like the same statement posted as a JSON body."""
+import io
+import json
+
+import pytest
+
+import main
+
+STATEMENT = {
+    "transactions": {
+        "booked": [
+            {"transactionAmount": {"amount": "100.0", "currency": "BGN"}, "bookingDate": "2024-01-05", "creditorName": "A"},
+            {"transactionAmount": {"amount": "-40.5", "currency": "BGN"}, "bookingDate": "2024-01-09", "creditorName": "B"},
+        ],
+        "pending": [
+            {"transactionAmount": {"amount": "12.0", "currency": "EUR"}, "bookingDate": "2024-01-11", "debtorName": "C"},
+        ],
+    }
+}
+
+
+@pytest.fixture
+def client():
+    main.result_cache.clear()
+    return main.app.test_client()
+
+
+def upload(client, path, body):
+    return client.post(path, data={"file": (io.BytesIO(body), "statement.json")})
+
+
+def test_read_transaction_columns_keeps_booked_before_pending():
+    columns = main.read_transaction_columns(io.BytesIO(json.dumps(STATEMENT).encode()))
+    assert columns == main.payload_columns(STATEMENT)
+
+
+def test_upload_matches_json_body(client):
+    expected = client.post("/analyze", json=STATEMENT).get_json()
+    assert upload(client, "/analyze", json.dumps(STATEMENT).encode()).get_json() == expected
+
+
+def test_upload_with_nan_literals(client):
+    body = json.dumps(STATEMENT).replace('"100.0"', "NaN").encode()
+    columns = main.read_transaction_columns(io.BytesIO(body))
+    assert columns["transactionAmount.amount"][0] != columns["transactionAmount.amount"][0]
+
+    assert upload(client, "/analyze", body).status_code == 200
+    assert upload(client, "/accounts/nan-upload/transactions?reset=1", body).status_code == 200
+    main.state_store.delete("nan-upload")
+
+
+@pytest.mark.parametrize("path", ["/analyze", "/accounts/malformed/transactions"])
+def test_malformed_upload(client, path):
+    response = upload(client, path, b'{"transactions": {"booked": [1,')
+    assert response.status_code == 400
+    assert response.get_json()["error"].startswith("Invalid JSON upload")